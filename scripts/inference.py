@@ -6,7 +6,7 @@ PARENT_PROJECT_FOLDER = os.path.dirname(PROJECT_FOLDER)
 sys.path.append(PARENT_PROJECT_FOLDER)
 
 from src.pipeline.passt_model import PasstModel
-from src.pipeline.effat_model import EffAtModel
+from src.pipeline.effat_model import EffAtModel, setup_logging
 from src.pipeline.vggish_model import VggishModel
 from src.pipeline.dataset import EcossDataset
 from src.pipeline.utils import create_exp_dir, load_yaml, visualize_inference
@@ -17,6 +17,7 @@ from dotenv import load_dotenv
 
 
 def main():
+    setup_logging()
     load_dotenv()
     YAML_PATH = os.getenv("YAML_PATH")
     MODEL_TYPE = os.getenv("MODEL_TYPE")
@@ -7,7 +7,7 @@ PARENT_PROJECT_FOLDER = os.path.dirname(PROJECT_FOLDER)
 sys.path.append(PARENT_PROJECT_FOLDER)
 
 from src.pipeline.passt_model import PasstModel
-from src.pipeline.effat_model import EffAtModel
+from src.pipeline.effat_model import EffAtModel, setup_logging
 from src.pipeline.vggish_model import VggishModel
 from src.pipeline.dataset import EcossDataset
 from src.pipeline.utils import create_exp_dir, load_yaml
@@ -19,6 +19,7 @@ import shutil
 
 
 def main():
+    setup_logging()
     # torch.set_float32_matmul_precision('high') #In a torch warning says you should run in this mode. I am not sure about the implications
     load_dotenv()
     ANNOTATIONS_PATHS = os.getenv("ANNOTATIONS_PATHS").split(',')
@@ -76,10 +77,7 @@ def main():
         for annot_path in ANNOTATIONS_PATHS:
             logging.info(annot_path)
             ecoss_data1 = EcossDataset(annot_path, PATH_STORE_DATA, PAD_MODE, sr, duration, "wav", DESIRED_MARGIN, yaml_content["window"])
-            ecoss_data1.add_file_column()
-            ecoss_data1.fix_onthology(labels=NEW_ONTOLOGY)
-            ecoss_data1.filter_overlapping()
-            ecoss_data1.drop_unwanted_labels(UNWANTED_LABELS)
+            ecoss_data1.load_and_prepare(labels=NEW_ONTOLOGY, unwanted_labels=UNWANTED_LABELS)
             ecoss_list.append(ecoss_data1)
         ecoss_data = EcossDataset.concatenate_ecossdataset(ecoss_list)
         length_prior_filter = len(ecoss_data.df)
@@ -9,13 +9,14 @@ Created on Mon Jul 29 13:27:48 2024
     and preprocessing steps. """
 
 import pandas as pd
+from pandas.api.types import union_categoricals
 import os
 from sklearn.model_selection import StratifiedShuffleSplit
 from matplotlib import pyplot as plt
+from matplotlib.figure import Figure
 from dotenv import load_dotenv
 import numpy as np
 from enum import Enum
-import librosa
 import pickle
 import os
 import soundfile as sf
@@ -24,9 +25,13 @@ import wave
 from mutagen.flac import FLAC
 from tqdm import tqdm
 import logging
-import torchaudio
-from scipy.signal import get_window
+from scipy.signal import get_window, resample_poly
+from math import gcd
 import random
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import copy
+import heapq
+import re
 
 from .utils import SuperpositionType
 
@@ -39,6 +44,61 @@ formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(messag
 handler.setFormatter(formatter)
 logger.addHandler(handler)
 
+# (index, start, stop) of each segment in the overlap_info column of annotations.csv
+# The index is the first whitespace delimited token made only of digits in the first field
+_OVERLAP_PATTERN = re.compile(r"[^,]*?(?<![^\s,])(\d+)(?![^\s,])[^,]*,([^,]*),([^,]*),")
+
+# EcossDataset (without its DataFrame) used by the worker processes of process_all_data
+_worker_dataset = None
+
+
+def _init_worker(dataset) -> None:
+    """
+    Initializer of the worker processes used by EcossDataset.process_all_data.
+
+    Parameters:
+    dataset (EcossDataset): The dataset whose parameters are used to process the annotations.
+    """
+    global _worker_dataset
+    _worker_dataset = dataset
+
+
+def _process_row(task: tuple) -> tuple:
+    """
+    Loads, processes and (if desired) saves on disk a single annotation. Defined at module level so it can be sent to the worker processes.
+
+    Parameters:
+    task (tuple): The file, tmin, tmax, label, split and number of occurrence of the file for the annotation.
+
+    Returns:
+    tuple: The processed segments, the label and the split of the annotation.
+    """
+    file, tmin, tmax, label, split, occurrence = task
+    dataset = _worker_dataset
+    # Load only the label segment from the audio file
+    with sf.SoundFile(file) as f:
+        original_sr = f.samplerate
+        start = min(int(original_sr*tmin), f.frames)
+        f.seek(start)
+        signal = f.read(max(int(original_sr*tmax) - start, 0), dtype='float32')
+    logger.debug(f"{signal}")
+    if dataset.window:
+        signal = signal * get_window('hamming', len(signal)).astype(signal.dtype)
+        logger.debug(f"Signal after the hamming window {signal}")
+    # Process the signal
+    segments = dataset.process_data(signal, original_sr)
+
+    path = Path(split) / label / f"{Path(file).stem}_{occurrence:03d}"
+    if dataset.saving_on_disk:
+        try:
+            # Save the processed segments to disk
+            dataset.save_data(segments, path)
+        except Exception as e:
+            logger.error('DataNotSaved', exc_info=True)
+
+    return segments, label, split
+
+
 class EcossDataset:
     """
     Class responsible to model the datasets generated by the W+B pipeline. It does the following steps (order is important):
@@ -63,7 +123,8 @@ class EcossDataset:
     several datasets from the FTP.
     """
     def __init__(self, path_dataset: str, path_store_data: str, pad_mode: str,
-                 sr: float, duration: float, saving_on_disk: bool, desired_margin: float, window: bool) -> None:
+                 sr: float, duration: float, saving_on_disk: bool, desired_margin: float, window: bool,
+                 save_workers: int = 4) -> None:
         """The constructor for the EcossDataset class.
 
         Args:
@@ -72,9 +133,10 @@ class EcossDataset:
             pad_mode (str): The mode for padding in case a signal is shorter than the desired duration. Availables: zeros, white noise
             sr (float): The sampling rate that the generated data will have. If signals with lower sampling rate are found, they are discarded.
             duration (float): The desired duration for the clips generated for the AI models.
-            saving_on_disk (bool): If set to True, the generated data will be saved on disk.
+            saving_on_disk (bool): The format used to save the generated data on disk (npy, pickle or wav). If False, the data is not saved.
             desired_margin (float): Is used in case that we cant visualize in the spectrogram the whole signature, and if we cant visualize this percentage we discard the signal (e.g 0.5)
             window (bool): If True, a Hamming window is used to cut the signals.
+            save_workers (int, optional): The number of threads used to write the clips of a signal to disk. Use 1 on rotating disks. Defaults to 4.
         """
         self.path_dataset = path_dataset
         self.path_store_data = path_store_data
@@ -88,8 +150,12 @@ class EcossDataset:
         if os.path.exists(os.path.join(self.path_dataset, 'samples for training')):
             self.path_dataset = os.path.join(self.path_dataset, 'samples for training')
         self.path_annots = os.path.join(self.path_dataset, 'annotations.csv')
-        self.df = pd.read_csv(self.path_annots, sep=";")
+        # label_source and parent_file have few unique values, as categories they are lighter and faster to group
+        self.df = pd.read_csv(self.path_annots, sep=";", dtype={"label_source": "category", "parent_file": "category"})
         self.window = window
+        self.save_workers = save_workers
+        # Polyphase resampling factors (up, down) for each original sampling rate found
+        self._resample_cache = {}
 
     @staticmethod
     def concatenate_ecossdataset(dataset_list: list):
@@ -115,6 +181,7 @@ class EcossDataset:
         path_store0 = dataset_list[0].path_store_data
         desired_margin0 = dataset_list[0].desired_margin
         window0 = dataset_list[0].window
+        save_workers0 = dataset_list[0].save_workers
         #Start populatinf DataFrame list
         df_list = [dataset_list[0].df]
         #Iterate over list to check appropiate values, exiting function it variables do not match
@@ -124,14 +191,47 @@ class EcossDataset:
                 return
             else:
                 df_list.append(dataset.df)
+        # Share the categories of the path and source columns between the DataFrames, so pd.concat keeps them
+        # as categoricals and only copies their codes instead of falling back to object columns
+        for column in ("label_source", "parent_file", "file"):
+            if not all(column in df.columns for df in df_list):
+                continue
+            categories = union_categoricals([df[column].astype("category") for df in df_list]).categories
+            dtype = pd.CategoricalDtype(categories)
+            for i, df in enumerate(df_list):
+                df_list[i] = df.copy(deep=False)
+                df_list[i][column] = df[column].astype(dtype)
         #Create EcossDataset object with concatenated info
         ConcatenatedEcoss = EcossDataset(path_dataset=path_dataset0, path_store_data=path_store0,
                                          pad_mode=padding0, sr=sr0, duration=duration0, saving_on_disk=save0,
-                                         desired_margin=desired_margin0, window=window0)
-        ConcatenatedEcoss.df = pd.concat(df_list,ignore_index=True)
+                                         desired_margin=desired_margin0, window=window0, save_workers=save_workers0)
+        ConcatenatedEcoss.df = pd.concat(df_list, ignore_index=True, copy=False)
         return ConcatenatedEcoss
 
 
+    def load_and_prepare(self, labels: list[str] = None, unwanted_labels: list = None, visualize_overlap: bool = False) -> None:
+        """
+        Runs the first steps of the pipeline over the annotations (fix_onthology, add_file_column, filter_overlapping and drop_unwanted_labels)
+        one after the other, so the drivers do not need to chain them.
+
+        The rows without label are dropped before building the file column, and the overlapping information parsed by
+        filter_overlapping is removed once it has been used, so it is not copied by the next steps.
+
+        Parameters:
+        labels (list[str]): The labels used to fix the onthology. If None, only the last part of the labels is kept.
+        unwanted_labels (list): The labels to be dropped.
+        visualize_overlap (bool): If True, visualizes the timeline of labels before and after filtering the overlapping.
+
+        Returns:
+        None (updates df attribute)
+        """
+        self.fix_onthology(labels=labels)
+        self.add_file_column()
+        self.filter_overlapping(visualize_overlap=visualize_overlap)
+        self.df.drop(columns=["overlap_info_processed"], inplace=True)
+        self.drop_unwanted_labels(unwanted_labels)
+
+
     def add_file_column(self) -> None:
         """
         Adds the file column in order to keep track of each file of the dataset
@@ -143,10 +243,9 @@ class EcossDataset:
         Returns:
         None (updates df atribute with an extra columnn named 'file')
         """
-        self.df["file"] = ''
-        for i, _ in self.df.iterrows():
-            self.df.at[i, "file"] = os.path.join(self.path_dataset,
-                                                 self.df.at[i, 'reference'])
+        # Joining with '' appends the trailing separator only when it is missing
+        base = os.path.join(self.path_dataset, '')
+        self.df["file"] = base + self.df["reference"].astype(str)
 
 
     def filter_lower_sr(self) -> None:
@@ -160,18 +259,42 @@ class EcossDataset:
         Returns:
         None (updates pd.DataFrame: original DataFrame by filtering the signals with a lower sampling rate)
         """
-        indexes_delete = []
-        for i, row in self.df.iterrows():
-            if os.path.isfile(row["file"]):
-                _,sr = torchaudio.load(row["file"],num_frames = 1)
-                if sr < self.sr:
-                    indexes_delete.append(i)
-                    logger.info(f"Deleting file {row['file']} because it's sampling rate its {sr}")
-            else:
-                indexes_delete.append(i)
-                logger.info(f"File {row['file']} in the folder is missing")
-
-        self.df.drop(indexes_delete, inplace=True)
+        # Sampling rates of previous runs, stored as {file: (mtime, size, sr)}
+        cache_path = Path(self.path_store_data) / 'sr_cache.pkl'
+        sr_cache = {}
+        if cache_path.is_file():
+            try:
+                with open(cache_path, 'rb') as f:
+                    sr_cache = pickle.load(f)
+            except Exception as e:
+                logger.warning(f"The sampling rate cache {cache_path} could not be read, it will be regenerated")
+
+        # Reading the headers is IO bound, so each unique file is probed once using a pool of threads
+        files = self.df["file"].unique().tolist()
+        max_workers = min(32, (os.cpu_count() or 1) * 4)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            probes = list(tqdm(executor.map(lambda file: self._probe_sr(file, sr_cache.get(file)), files),
+                               total=len(files), desc='Reading sampling rates'))
+
+        files_sr = {}
+        for file, probe in zip(files, probes):
+            if probe is None:
+                logger.info(f"File {file} in the folder is missing")
+                files_sr[file] = None
+                continue
+            sr_cache[file] = probe
+            sr = probe[2]
+            if sr < self.sr:
+                logger.info(f"Deleting file {file} because it's sampling rate its {sr}")
+            files_sr[file] = sr
+
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(cache_path, 'wb') as f:
+            pickle.dump(sr_cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        # Missing files are mapped to NaN, which is never >= self.sr
+        mask = self.df["file"].map(files_sr).astype(float) >= self.sr
+        self.df = self.df[mask]
         self.df.reset_index(drop=True, inplace=True)
 
 
@@ -243,12 +366,9 @@ class EcossDataset:
         Returns:
         None (updates pd.DataFrame: original DataFrame with an extra columnn named 'split')
         """
-        # Creates a DataFrame with unique files and their labels
-        file_labels = self.df.groupby('parent_file')['final_source'].apply(
-            lambda x: x.mode()[0]).reset_index()
-
-        # Initialize column split in the original DataFrame
-        self.df['split'] = ''
+        # Creates a DataFrame with unique files and their most common label (the first one in alphabetical order on ties)
+        counts = self.df.groupby(['parent_file', 'final_source'], observed=True).size()
+        file_labels = counts.groupby(level=0, observed=True).idxmax().str[1].rename('final_source').reset_index()
 
         # Handle classes with only one instance
         single_instance_files = file_labels[file_labels.duplicated('final_source', keep=False) == False]
@@ -264,9 +384,10 @@ class EcossDataset:
         # Add single instance files to the train set
         train_files = pd.concat([train_files, single_instance_files['parent_file']])
 
-        # Assign in the original DataFrame 'train' or 'test' in columns 'split'
-        self.df.loc[self.df['parent_file'].isin(train_files), 'split'] = 'train'
-        self.df.loc[self.df['parent_file'].isin(test_files), 'split'] = 'test'
+        # Assign in the original DataFrame 'train' or 'test' in columns 'split' ('' for files without a label)
+        split_map = {file: 'train' for file in train_files}
+        split_map.update({file: 'test' for file in test_files})
+        self.df['split'] = self.df['parent_file'].map(split_map).astype(object).fillna('')
 
 
     def filter_overlapping(self, visualize_overlap = False) -> None:
@@ -279,57 +400,87 @@ class EcossDataset:
         Returns:
         None
         """
-        if "overlapping" not in self.df.columns:
-            self.df["overlapping"] = False
-        overlap_info_processed = self._extract_overlapping_info()
+        if "overlap_info" in self.df.columns:
+            if "overlapping" not in self.df.columns:
+                self.df["overlapping"] = False
+            overlap_info_processed = self._extract_overlapping_info()
+        else:
+            # The annotations do not include the overlapping information, so it is computed from tmin and tmax
+            overlap_info_processed = self._find_overlapping_info()
+            self.df["overlapping"] = [True if info else np.nan for info in overlap_info_processed]
         
         self.df["overlap_info_processed"] = overlap_info_processed
         # self.df.dropna(subset=["final_source"],inplace=True)
-        self.df["to_delete"] = False
         if visualize_overlap:
             self._visualize_overlappping(self.df)
+        # Positional lookups of the columns that are not modified during the loop
+        idx_to_pos = {idx: i for i, idx in enumerate(self.df.index)}
+        final_sources = self.df["final_source"].to_numpy()
+        # tmin and tmax are updated in place by _handle_superposition and written back after the loop
+        self._tmin = self.df["tmin"].to_numpy(dtype=float, copy=True)
+        self._tmax = self.df["tmax"].to_numpy(dtype=float, copy=True)
+        # Rows to be removed after the loop (the events replaced by their subevents and the contained ones)
+        self._delete_mask = np.zeros(len(self.df), dtype=bool)
+        # Flatten the (evaluated, overlapping) pairs of all the rows, skipping the overlapping rows no longer in the DataFrame
+        pairs = [(eval_pos, idx_to_pos[overlap_idx], tmin, tmax)
+                 for eval_pos, overlap_info in enumerate(self.df["overlap_info_processed"])
+                 for overlap_idx, tmin, tmax in overlap_info if overlap_idx in idx_to_pos]
+        pair_eval = np.array([pair[0] for pair in pairs], dtype=int)
+        pair_overlap = np.array([pair[1] for pair in pairs], dtype=int)
+        pair_segments = np.array([pair[2:] for pair in pairs], dtype=float).reshape(-1, 2)
+        pair_bounds = np.searchsorted(pair_eval, np.arange(len(self.df) + 1))
+        # Classify all the pairs at once. The intervals only shrink during the loop, so the pairs with no
+        # superposition at this point never overlap later and do not need to be checked again
+        pair_same_source = final_sources[pair_eval] == final_sources[pair_overlap]
+        pair_superposed = self._check_superpositions(self._tmin[pair_eval], self._tmax[pair_eval],
+                                                     self._tmin[pair_overlap], self._tmax[pair_overlap]) != SuperpositionType.NO_SUPERPOSITION.value
+        # The subevents are accumulated and added to the DataFrame at once after the loop
+        new_rows = []
+        new_indexes = []
+        next_idx = int(self.df.index.max()) + 1
         # Iterate through the DataFrame to handle overlapping segments
-        for eval_idx,_ in self.df.iterrows():
+        for eval_pos, (eval_idx, overlapping) in enumerate(self.df["overlapping"].items()):
             not_count = False
-            if not eval_idx in self.df.index:
-                continue
-            if np.isnan(self.df.loc[eval_idx]["overlapping"]):
+            if pd.isna(overlapping):
                 continue
-            segments_to_delete = []
-            for overlap_idx,tmin,tmax in self.df.loc[eval_idx]["overlap_info_processed"]:
-                tmin = float(tmin)
-                tmax = float(tmax)
-                if overlap_idx not in self.df.index:
-                    continue
-                if self.df.loc[eval_idx]["final_source"] != self.df.loc[overlap_idx]["final_source"]:
+            pairs_to_delete = []
+            for pair in range(pair_bounds[eval_pos], pair_bounds[eval_pos + 1]):
+                if not pair_same_source[pair]:
                     # Add to segments_to_delete everytime there is overlapping different class sources
-                    segments_to_delete.append([tmin,tmax])
-                else:
+                    pairs_to_delete.append(pair)
+                elif pair_superposed[pair]:
                     # Handle when the two overlapping segments are from the same class
-                    t_eval = [self.df.loc[eval_idx]['tmin'],self.df.loc[eval_idx]["tmax"]]
-                    t_overlap = [self.df.loc[overlap_idx]['tmin'],self.df.loc[overlap_idx]["tmax"]]
+                    overlap_pos = pair_overlap[pair]
+                    t_eval = [self._tmin[eval_pos], self._tmax[eval_pos]]
+                    t_overlap = [self._tmin[overlap_pos], self._tmax[overlap_pos]]
 
                     superpos = self._check_superposition(t_eval,t_overlap)
-                    not_count = self._handle_superposition(eval_idx, overlap_idx, superpos)
+                    not_count = self._handle_superposition(eval_pos, overlap_pos, superpos)
                     if not_count:
                         break
             if not_count:
                 continue
             # Divide the event into subevents excluding the segments_to_delete
-            final_segments = self._divide_labels([self.df.loc[eval_idx]["tmin"],self.df.loc[eval_idx]["tmax"]],segments_to_delete)
+            final_segments = self._divide_labels([self._tmin[eval_pos], self._tmax[eval_pos]], pair_segments[pairs_to_delete])
+            # The row is extracted once and shared by all its subevents
+            eval_row = self.df.loc[eval_idx].to_dict()
             for tmin,tmax in final_segments:
-                new_row = self.df.loc[eval_idx].copy()
-                new_row["tmin"] = tmin
-                new_row["tmax"] = tmax
-                new_df = pd.DataFrame([new_row])
-                new_df.index = [np.max(self.df.index)+1]
-                self.df = pd.concat([self.df,new_df], axis=0)
-
-            self.df.at[eval_idx,'to_delete'] = True
-
-        # Remove rows marked for deletion
-        self.df.drop(self.df[self.df["to_delete"]==True].index,inplace=True)
-        self.df.drop(columns=['to_delete'], inplace=True)
+                new_rows.append({**eval_row, "tmin": tmin, "tmax": tmax})
+                new_indexes.append(next_idx)
+                next_idx += 1
+
+            self._delete_mask[eval_pos] = True
+
+        self.df["tmin"] = self._tmin
+        self.df["tmax"] = self._tmax
+        # Remove rows marked for deletion and add the subevents
+        self.df = self.df.loc[~self._delete_mask]
+        del self._tmin, self._tmax, self._delete_mask
+
+        if new_rows:
+            new_df = pd.DataFrame(new_rows, index=new_indexes)
+            self.df = pd.concat([self.df,new_df], axis=0)
+
         self.df.reset_index(drop=True, inplace=True)
         if visualize_overlap:
             self._visualize_overlappping(self.df,"_postprocessed")
@@ -349,13 +500,12 @@ class EcossDataset:
         None.
 
         """
-        idxs_to_drop = []
-        for i, row in self.df.iterrows():
-            for label in unwanted_labels:
-                if label.lower() == row["final_source"].lower():
-                    idxs_to_drop.append(i)
-
-        self.df = self.df.drop(idxs_to_drop)
+        if not unwanted_labels:
+            return
+        # Case insensitive comparison done in a single vectorized pass (index is not reset)
+        unwanted_labels = [label.lower() for label in unwanted_labels]
+        mask = self.df["final_source"].str.lower().isin(unwanted_labels)
+        self.df = self.df[~mask]
 
 
     def fix_onthology(self, labels: list[str] = None) -> None:
@@ -382,21 +532,26 @@ class EcossDataset:
         if not labels:
             labels = None
         if labels != None:
-            for i, row in self.df.iterrows():
-                for label in labels:
-                    idx = row["label_source"].find(label)
-                    if idx != -1:
-                        delimiter = idx + len(label)
-                        self.df.loc[i, "label_source"] = self.df.loc[i, "label_source"][:delimiter]
+            label_source = self.df["label_source"]
+            # Position where each label_source has to be cut, the shortest matching label wins
+            delimiters = label_source.str.len()
+            for label in labels:
+                idx = label_source.str.find(label)
+                delimiters = delimiters.where(idx == -1, np.minimum(delimiters, idx + len(label)))
+            self.df["label_source"] = [source[:delimiter] for source, delimiter in zip(label_source, delimiters)]
 
         # Once they are defined, we create the final column with the labels
         # Currently not saving, only overwritting the df parameter as this is the first step
-        self.df["final_source"] = self.df["label_source"].apply(lambda x: x.split('|')[-1])
+        self.df["final_source"] = self.df["label_source"].str.rsplit('|', n=1).str[-1]
 
 
-    def process_all_data(self) -> None:
+    def process_all_data(self, max_workers: int = None) -> None:
         """
         Process the signals and return processed signals, labels, and splits according to the sample rate, duration, and pad_mode chosen.
+        The annotations are processed in parallel using a pool of processes.
+
+        Parameters:
+        max_workers (int): The number of processes used. If None, the number of CPUs of the machine is used.
 
         Returns:
         tuple: A tuple containing three lists:
@@ -407,51 +562,29 @@ class EcossDataset:
         processed_signals = []
         processed_labels = []
         processed_splits = []
-        files_dict = {}
 
         if self.saving_on_disk:
             logger.info(f"Files will be saved in {self.path_store_data}")
         else:
             logger.info(f"Files will not be saved in disk")
-        file = ""
-        # Iterate over all signals, sr, paths, labels
-        for _,row in tqdm(self.df.iterrows(), total=self.df.shape[0],desc='Processing Audios'):
-            # Load audio file
-            if file != row["file"]:
-                file  = row["file"]
-                original_signal, original_sr = sf.read(file)
-
-            if "final_source" in row.index:
-                label = row["final_source"]
-            else:
-                label = row["label_source"]
-            split = row["split"]
-            # Extract only the label segment
-            signal = original_signal[int(original_sr*row["tmin"]):int(original_sr*row["tmax"])]
-            logger.debug(f"{signal}")
-            if self.window:
-                signal = signal * get_window('hamming', len(signal))
-                logger.debug(f"Signal after the hamming window {signal}")
-            # Process the signal
-            segments = self.process_data(signal, original_sr)
-            # Count how many times
-            if file in files_dict:
-                files_dict[file] += 1
-            else:
-                files_dict[file] = 0
-
-            path = Path(row["split"]) / label / f"{Path(row['file']).stem}_{files_dict[row['file']]:03d}"
-            if self.saving_on_disk:
-                try:
-                    # Save the processed segments to disk
-                    if self.saving_on_disk:
-                        self.save_data(segments, path)
-                except Exception as e:
-                    logger.error('DataNotSaved', exc_info=True)
-            # Extend the lists of processed signals and labels
-            processed_signals.extend(segments)
-            processed_labels.extend([label] * len(segments))
-            processed_splits.extend([split] * len(segments))
+
+        # Count how many times each file has appeared, computed before dispatching so every task knows its name
+        occurrences = self.df.groupby("file", sort=False, observed=True).cumcount()
+
+        label_column = "final_source" if "final_source" in self.df.columns else "label_source"
+        tasks = list(zip(self.df["file"], self.df["tmin"], self.df["tmax"],
+                         self.df[label_column], self.df["split"], occurrences))
+
+        # The workers only need the parameters of the dataset, not the DataFrame
+        worker_dataset = copy.copy(self)
+        worker_dataset.df = None
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(worker_dataset,)) as executor:
+            results = executor.map(_process_row, tasks, chunksize=4)
+            for segments, label, split in tqdm(results, total=len(tasks), desc='Processing Audios'):
+                # Extend the lists of processed signals and labels
+                processed_signals.extend(segments)
+                processed_labels.extend([label] * len(segments))
+                processed_splits.extend([split] * len(segments))
 
         # Ensure the lengths of signals and labels match
         assert len(processed_signals)==len(processed_labels),f'Error : signals and labels processed have different length. Signal: {len(processed_signals)}, labels: {len(processed_labels)}'
@@ -471,7 +604,10 @@ class EcossDataset:
         """
         # Resample the signal if the original sampling rate is different from the target
         if original_sr != self.sr:
-            signal = librosa.resample(y=signal, orig_sr=original_sr, target_sr=self.sr)
+            if original_sr not in self._resample_cache:
+                self._resample_cache[original_sr] = self._resample_ratio(original_sr, self.sr)
+            up, down = self._resample_cache[original_sr]
+            signal = resample_poly(signal, up, down)
 
         # Pad the signal if it is shorter than the segment length
         if len(signal) < self.segment_length:
@@ -493,18 +629,15 @@ class EcossDataset:
         Returns:
         list: List of signal segments.
         """
-        segments = []
         # Calculate the number of full segments in the signal
         n_segments = len(signal)//(self.segment_length)
-        # Extract each segment and append to the list
-        for i in range(n_segments):
-            segment = signal[(i*self.segment_length):((i+1)*self.segment_length)]
-            logger.debug(f"{segment}")
-            if self.window:
-                segment = segment * get_window('hamming', ((i+1)*self.segment_length) - (i*self.segment_length))
-                logger.debug(f"Segment after the hamming window {segment}")
-            segments.append(segment)
-        return segments
+        # Reshape the full segments into a 2D view, one segment per row
+        segments = signal[:n_segments*self.segment_length].reshape(n_segments, self.segment_length)
+        logger.debug(f"{segments}")
+        if self.window:
+            segments = segments * get_window('hamming', self.segment_length).astype(segments.dtype)
+            logger.debug(f"Segments after the hamming window {segments}")
+        return list(segments)
 
 
     def make_padding(self, signal: np.ndarray) -> list[np.ndarray]:
@@ -548,7 +681,9 @@ class EcossDataset:
         Returns:
         np.array: Zero-padded signal.
         """
-        segment = np.pad(signal, (delta_start, delta_end), 'constant', constant_values=(0, 0))
+        # Preallocated buffer keeps the dtype of the signal (float32) without going through np.pad
+        segment = np.zeros(delta_start + len(signal) + delta_end, dtype=signal.dtype)
+        segment[delta_start:delta_start + len(signal)] = signal
 
         return segment
 
@@ -567,11 +702,15 @@ class EcossDataset:
         """
         # Generate white noise with standard deviation scaled to the signal
         std = np.std(signal)/10
-        white_noise_start = np.random.normal(loc=0, scale=std, size=delta_start)
-        white_noise_end = np.random.normal(loc=0, scale=std, size=delta_end)
 
-        # Concatenate white noise segments with the original signal
-        segment = np.concatenate((white_noise_start, signal, white_noise_end))
+        # The noise is drawn directly into a preallocated buffer around the original signal
+        segment = np.empty(delta_start + len(signal) + delta_end, dtype=signal.dtype)
+        end = delta_start + len(signal)
+        rng = np.random.default_rng()
+        for noise in (segment[:delta_start], segment[end:]):
+            rng.standard_normal(out=noise, dtype=segment.dtype)
+            noise *= std
+        segment[delta_start:end] = signal
 
         return segment
     
@@ -596,7 +735,7 @@ class EcossDataset:
             if random.choice([True, False]):
                 noise_length = random.randint(1, max(1,int(2 * (self.segment_length - total_length) / 3)))
                 # Add white noise at the beginning
-                white_noise = np.random.normal(loc=0, scale=np.std(signal) / 10, size=noise_length)
+                white_noise = np.random.normal(loc=0, scale=np.std(signal) / 10, size=noise_length).astype(signal.dtype)
                 segments.append(white_noise)
                 total_length += noise_length
             else:
@@ -615,16 +754,17 @@ class EcossDataset:
 
     def save_data(self, segments: list[np.ndarray], path: str) -> None:
         """
-        Save the processed segments to disk in the specified format (pickle or wav).
+        Save the processed segments to disk in the specified format (npy, pickle or wav).
 
         Parameters:
         segments (list): List of processed segments to be saved.
         path (str): Path to the directory where the segments will be saved.
 
         Raises:
-        ValueError: If the saving format specified in self.saving_on_disk is not 'pickle' or 'wav'.
+        ValueError: If the saving format specified in self.saving_on_disk is not 'npy', 'pickle' or 'wav'.
 
         Notes:
+        - If the saving format is 'npy', each segment will be saved as a separate .npy file (raw buffer, faster than pickle).
         - If the saving format is 'pickle', each segment will be saved as a separate pickle file.
         - If the saving format is 'wav', each segment will be saved as a separate wave file.
         - The files will be saved in the directory specified by self.path_store_data combined with the provided path.
@@ -634,19 +774,31 @@ class EcossDataset:
         save_path = Path(self.path_store_data) / path
         save_path.parent.mkdir(parents = True, exist_ok = True)
         filename = save_path
-        if self.saving_on_disk == "pickle":
-            # Save each segment as a separate pickle file
-            for idx, segment in enumerate(segments):
+        if self.saving_on_disk not in ("npy", "pickle", "wav"):
+            raise ValueError(f"saving_on_disk should be npy, pickle or wav, not {self.saving_on_disk}")
+
+        def _write_one(idx: int, segment: np.ndarray) -> None:
+            if self.saving_on_disk == "npy":
+                # Save each segment as a separate npy file (load them with np.load)
+                saving_filename = str(filename) + '-' + f"{idx:03d}" + '.npy'
+                np.save(saving_filename, segment, allow_pickle=False)
+            elif self.saving_on_disk == "pickle":
+                # Save each segment as a separate pickle file
                 saving_filename = str(filename) + '-' + f"{idx:03d}" + '.pickle'
                 with open(saving_filename, 'wb') as f:
                     pickle.dump(segment, f, protocol=pickle.HIGHEST_PROTOCOL)
-        elif self.saving_on_disk == "wav":
-            # Save each segment as a separate wave file
-            for idx, segment in enumerate(segments):
+            else:
+                # Save each segment as a separate wave file
                 saving_filename = str(filename) + '-' + f"{idx:03d}" + '.wav'
                 sf.write(saving_filename, segment, int(self.sr))
+
+        # The writes are IO bound, so they are done with a pool of threads unless save_workers is 1 (e.g. HDDs)
+        if self.save_workers > 1 and len(segments) > 1:
+            with ThreadPoolExecutor(max_workers=self.save_workers) as executor:
+                list(executor.map(_write_one, range(len(segments)), segments))
         else:
-            raise ValueError(f"saving_on_disk should be pickle or wav, not {self.saving_on_disk}")
+            for idx, segment in enumerate(segments):
+                _write_one(idx, segment)
 
 
     def generate_insights(self) -> None:
@@ -678,17 +830,13 @@ class EcossDataset:
         logger.info(f"Number of sound signatures per source: {count_signatures}\n")
 
         # Plot for time per class of sound signature
-        times = dict()
-        for _, row in self.df.iterrows():
-            if row["final_source"] not in times.keys():
-                times[row["final_source"]] = float(row["tmax"]) - float(row["tmin"])
-            else:
-                times[row["final_source"]] += float(row["tmax"]) - float(row["tmin"])
-    
+        durations = self.df["tmax"].astype(float) - self.df["tmin"].astype(float)
+        times = durations.groupby(self.df["final_source"], sort=False).sum()
+
         plt.figure(figsize=(8,6))
-        plt.bar(range(0, len(times)), times.values())
+        plt.bar(range(0, len(times)), times.values)
         plt.xticks(range(0, len(times)),
-                   list(times.keys()),
+                   times.index.to_list(),
                    horizontalalignment='center',
                    rotation=45)
         plt.xlabel("Source")
@@ -732,30 +880,19 @@ class EcossDataset:
             plt.show()
 
             # Time related
-            times_train = dict()
-            times_test = dict()
-
-            for _, row in df_train.iterrows():
-                if row["final_source"] not in times_train.keys():
-                    times_train[row["final_source"]] = float(row["tmax"]) - float(row["tmin"])
-                else:
-                    times_train[row["final_source"]] += float(row["tmax"]) - float(row["tmin"])
-            for _, row in df_test.iterrows():
-                if row["final_source"] not in times_test.keys():
-                    times_test[row["final_source"]] = float(row["tmax"]) - float(row["tmin"])
-                else:
-                    times_test[row["final_source"]] += float(row["tmax"]) - float(row["tmin"])
+            times_train = durations[self.df["split"] == "train"].groupby(df_train["final_source"], sort=False).sum()
+            times_test = durations[self.df["split"] == "test"].groupby(df_test["final_source"], sort=False).sum()
 
             _, ax = plt.subplots(ncols=2, figsize=(12,6))
-            ax[0].bar(range(0, len(times_train)), times_train.values())
-            ax[1].bar(range(0, len(times_test)), times_test.values())
+            ax[0].bar(range(0, len(times_train)), times_train.values)
+            ax[1].bar(range(0, len(times_test)), times_test.values)
 
             ax[0].set_xticks(range(0, len(times_train)),
-                               list(times_train.keys()),
+                               times_train.index.to_list(),
                                horizontalalignment='center',
                                rotation=45)
             ax[1].set_xticks(range(0, len(times_test)),
-                               list(times_test.keys()),
+                               times_test.index.to_list(),
                                horizontalalignment='center',
                                rotation=45)
 
@@ -780,16 +917,40 @@ class EcossDataset:
         Returns:
         list: A list of processed overlapping information for each row in the DataFrame.
         """
-        overlap_info_processed = []
-        # Process each row to handle overlapping information
-        for _,row in self.df.iterrows():
-            if pd.isna(row["overlapping"]):
-                overlap_info_processed.append([])
-                continue
-            overlap_info_processed.append(self._parse_overlapping_field(str(row["overlap_info"])))
+        # Only the rows flagged as overlapping have information to parse
+        mask = self.df["overlapping"].notna().to_numpy()
+        overlap_info = self.df["overlap_info"].to_numpy()
+        overlap_info_processed = [self._parse_overlapping_field(str(info)) if overlapping else []
+                                  for info, overlapping in zip(overlap_info, mask)]
         return overlap_info_processed
 
 
+    def _find_overlapping_info(self) -> list[list[tuple]]:
+        """
+        Helper method to find the overlapping segments of each row in the DataFrame when the annotations do not include them.
+        Uses a sweep line over the segments of each parent file sorted by tmin, so only the pairs that actually overlap are visited.
+
+        Returns:
+        list: A list with the (index, start, stop) of the segments overlapping each row in the DataFrame.
+        """
+        tmins = self.df["tmin"].to_numpy(dtype=float)
+        tmaxs = self.df["tmax"].to_numpy(dtype=float)
+        indexes = self.df.index.to_numpy()
+        overlap_info = [[] for _ in range(len(self.df))]
+        for positions in self.df.groupby("parent_file", sort=False, observed=True).indices.values():
+            # Segments still active at the current tmin, as a heap of (tmax, position)
+            active = []
+            for pos in positions[np.argsort(tmins[positions], kind="stable")]:
+                while active and active[0][0] <= tmins[pos]:
+                    heapq.heappop(active)
+                for _, other in active:
+                    overlap_info[pos].append((indexes[other], tmins[other], tmaxs[other]))
+                    overlap_info[other].append((indexes[pos], tmins[pos], tmaxs[pos]))
+                heapq.heappush(active, (tmaxs[pos], pos))
+        # Keep the overlapping segments in the order of the DataFrame
+        return [sorted(info, key=lambda x: x[0]) for info in overlap_info]
+
+
     def _visualize_overlappping(self, df: pd.DataFrame, append: str = "") -> None:
         """
         Visualizes overlapping segments for each unique parent file in the DataFrame.
@@ -801,20 +962,16 @@ class EcossDataset:
         Returns:
         None
         """
-        # Get unique parent files
-        files = df["parent_file"].unique()
-
-        for file in files:
-            segments = []
-            labels = []
-
-            # Iterate through rows corresponding to the current parent file
-            for _, row in df[df["parent_file"] == file].iterrows():
-                segments.append([row['tmin'], row["tmax"]])
-                labels.append(row['final_source'])
+        # Group the rows by parent file in a single pass
+        tasks = []
+        for file, df_file in df.groupby("parent_file", sort=False, observed=True):
+            segments = df_file[["tmin", "tmax"]].to_numpy().tolist()
+            labels = df_file["final_source"].tolist()
+            tasks.append((segments, labels, file, append))
 
-            # Plot segments for the current file
-            self._plot_segments(segments, labels, file, append=append)
+        # Plot segments for each file, the figures do not use pyplot so they can be rendered and saved from several threads
+        with ThreadPoolExecutor() as executor:
+            list(executor.map(lambda task: self._plot_segments(*task), tasks))
 
 
     @staticmethod
@@ -832,7 +989,8 @@ class EcossDataset:
         None
         """
         try:
-            fig, ax = plt.subplots()
+            fig = Figure()
+            ax = fig.subplots()
             labels_unique = list(np.unique(labels))
             # Plot each segment
             for i, (t_min, t_max) in enumerate(segments):
@@ -843,11 +1001,47 @@ class EcossDataset:
             ax.set_title(f'{filename}')
             ax.set_xlim([0, np.max(segments) + 10])
             # Save the plot
-            plt.savefig(filename + append + ".png")
+            fig.savefig(filename + append + ".png")
         except Exception as e:
             logger.error('ErrorPlotting', exc_info=True)
-        finally:
-            plt.close(fig)
+
+
+    @staticmethod
+    def _resample_ratio(original_sr: float, target_sr: float) -> tuple[int, int]:
+        """
+        Computes the smallest upsampling and downsampling factors to go from original_sr to target_sr.
+
+        Parameters:
+        original_sr (float): Original sampling rate of the signal.
+        target_sr (float): Desired sampling rate.
+
+        Returns:
+        tuple: The (up, down) factors to be used with scipy.signal.resample_poly.
+        """
+        original_sr, target_sr = int(original_sr), int(target_sr)
+        divisor = gcd(original_sr, target_sr)
+        return target_sr // divisor, original_sr // divisor
+
+
+    @staticmethod
+    def _probe_sr(path: str, cached: tuple = None):
+        """
+        Reads the sampling rate from the header of an audio file without decoding the samples.
+        If the cached entry matches the modification time and size of the file, the header is not read.
+
+        Parameters:
+        path (str): Path to the audio file.
+        cached (tuple): The (mtime, size, sr) stored for the file in a previous run, if any.
+
+        Returns:
+        tuple or None: The (mtime, size, sr) of the file, or None if the file is missing.
+        """
+        if not os.path.isfile(path):
+            return None
+        stat = os.stat(path)
+        if cached is not None and tuple(cached[:2]) == (stat.st_mtime, stat.st_size):
+            return cached
+        return stat.st_mtime, stat.st_size, sf.info(path).samplerate
 
 
     @staticmethod
@@ -861,20 +1055,17 @@ class EcossDataset:
         Returns:
         list of tuples: A list where each tuple contains (index, start, stop) for each overlapping segment.
         """
-        # Split the string by commas and remove the last empty element
-        overlapping_str = overlapping_str.split(",")[:-1]
-
-        # Group the elements into sublists of three elements each
-        divided_list = [overlapping_str[i:i + 3] for i in range(0, len(overlapping_str), 3)]
-
+        # Each overlapping segment is written as "<name> <index>,<name>: <start>,<name>: <stop>,"
         overlap_info = []
+        position = 0
+        while (match := _OVERLAP_PATTERN.match(overlapping_str, position)):
+            index, start, stop = match.groups()
+            overlap_info.append((int(index), float(start.split(':')[-1]), float(stop.split(':')[-1])))
+            position = match.end()
 
-        # Parse each sublist to extract index, start, and stop values
-        for x in divided_list:
-            index = [int(s) for s in x[0].split() if s.isdigit()][0]
-            start = float(x[1].split(':')[-1])
-            stop = float(x[2].split(':')[-1])
-            overlap_info.append((index, start, stop))
+        # Everything up to the last comma has to be made of complete segments
+        if ',' in overlapping_str[position:]:
+            raise ValueError(f"Malformed overlapping segment information: {overlapping_str!r}")
 
         return overlap_info
 
@@ -907,62 +1098,97 @@ class EcossDataset:
 
 
     @staticmethod
-    def _divide_labels(event: list, segments: list[list]) -> list[list]:
+    def _check_superpositions(t_min1: np.ndarray, t_max1: np.ndarray, t_min2: np.ndarray, t_max2: np.ndarray) -> np.ndarray:
+        """
+        Vectorized version of _check_superposition, checks the superposition between pairs of time intervals.
+
+        Parameters:
+        t_min1, t_max1 (np.ndarray): The time intervals of the first segments.
+        t_min2, t_max2 (np.ndarray): The time intervals of the second segments.
+
+        Returns:
+        np.ndarray: The value of the SuperpositionType of each pair.
+        """
+        conditions = [(t_min1 <= t_min2) & (t_min2 <= t_max1) & (t_max1 < t_max2),
+                      (t_min2 <= t_min1) & (t_min1 <= t_max2) & (t_max2 < t_max1),
+                      (t_min1 <= t_min2) & (t_max1 >= t_max2),
+                      (t_min2 <= t_min1) & (t_max2 >= t_max1)]
+        choices = [SuperpositionType.STARTS_BEFORE_AND_OVERLAPS.value,
+                   SuperpositionType.STARTS_AFTER_AND_OVERLAPS.value,
+                   SuperpositionType.CONTAINS.value,
+                   SuperpositionType.IS_CONTAINED.value]
+        return np.select(conditions, choices, default=SuperpositionType.NO_SUPERPOSITION.value)
+
+
+    @staticmethod
+    def _divide_labels(event: list, segments: np.ndarray) -> list[list]:
         """
         Divides an event into subevents by excluding specified segments.
 
         Parameters:
         event (list): A list containing the start and end times of the event [tmin, tmax].
-        segments (list of lists): A list of [tmin, tmax] pairs representing the segments to exclude.
+        segments (np.ndarray): An array of shape (n, 2) (or a list) with the [tmin, tmax] pairs representing the segments to exclude.
 
         Returns:
         list of lists: A list of [tmin, tmax] pairs representing the subevents.
         """
-        event = [float(x) for x in event]
-        tmin, tmax = event
-        subevents = []
-        start = tmin
-
-        # Sort the segments by their start time
-        segments.sort()
+        tmin, tmax = [float(x) for x in event]
+        # Sort the segments by their start time (without modifying the segments received)
+        segments = np.asarray(segments, dtype=float).reshape(-1, 2)
+        segments = segments[np.argsort(segments[:, 0], kind="stable")]
 
-        for segment in segments:
-            if segment[0] > start:
-                subevents.append([start, segment[0]])
-            # Update the start to the maximum between the end of the current segment and the current start
-            start = max(start, segment[1])
+        # Start of the pending subevent before each segment: the maximum between tmin and the end of the previous segments
+        starts = np.maximum.accumulate(np.concatenate(([tmin], segments[:, 1])))
+        # A subevent ends wherever a segment begins after the pending start
+        gaps = segments[:, 0] > starts[:-1]
+        subevents = np.column_stack((starts[:-1][gaps], segments[gaps, 0])).tolist()
 
-        if start < tmax:
-            subevents.append([start, tmax])
+        if starts[-1] < tmax:
+            subevents.append([float(starts[-1]), tmax])
 
         return subevents
 
 
-    def _handle_superposition(self, eval_idx: int, overlap_idx: int, superpos) -> bool:
+    def _handle_superposition(self, eval_pos: int, overlap_pos: int, superpos) -> bool:
         """
-        Handles the superposition between two segments.
+        Handles the superposition between two segments. Used by filter_overlapping, it updates the
+        tmin, tmax and delete mask arrays it keeps while looping.
 
         Parameters:
-        eval_idx (int): The index of the evaluated segment.
-        overlap_idx (int): The index of the overlapping segment.
+        eval_pos (int): The position of the evaluated segment in the DataFrame.
+        overlap_pos (int): The position of the overlapping segment in the DataFrame.
         superpos (SuperpositionType): The type of superposition.
 
         Returns:
         bool: True if the evaluated segment should not be counted, False otherwise.
         """
-        if superpos == SuperpositionType.STARTS_BEFORE_AND_OVERLAPS:
-            self.df.at[eval_idx, 'tmax'] = self.df.loc[overlap_idx]["tmin"]
-            self.df.at[overlap_idx, 'tmin'] = self.df.loc[eval_idx]["tmax"]
-            return False
-        elif superpos == SuperpositionType.STARTS_AFTER_AND_OVERLAPS:
-            self.df.at[eval_idx, 'tmin'] = self.df.loc[overlap_idx]["tmax"]
-            self.df.at[overlap_idx, 'tmax'] = self.df.loc[eval_idx]["tmin"]
-            return False
-        elif superpos == SuperpositionType.IS_CONTAINED:
-            self.df.at[eval_idx, 'to_delete'] = True
-            return True
-        else:
-            return False
+        # Dispatch on the type of superposition with a single lookup instead of comparing against every type
+        handler = self._superposition_handlers.get(superpos)
+        return handler(self, eval_pos, overlap_pos) if handler else False
+
+    def _handle_starts_before(self, eval_pos: int, overlap_pos: int) -> bool:
+        """Handles SuperpositionType.STARTS_BEFORE_AND_OVERLAPS, the evaluated segment is cut where the overlapping one starts."""
+        self._tmax[eval_pos] = self._tmin[overlap_pos]
+        self._tmin[overlap_pos] = self._tmax[eval_pos]
+        return False
+
+    def _handle_starts_after(self, eval_pos: int, overlap_pos: int) -> bool:
+        """Handles SuperpositionType.STARTS_AFTER_AND_OVERLAPS, the evaluated segment starts where the overlapping one ends."""
+        self._tmin[eval_pos] = self._tmax[overlap_pos]
+        self._tmax[overlap_pos] = self._tmin[eval_pos]
+        return False
+
+    def _handle_contained(self, eval_pos: int, overlap_pos: int) -> bool:
+        """Handles SuperpositionType.IS_CONTAINED, the evaluated segment is deleted."""
+        self._delete_mask[eval_pos] = True
+        return True
+
+    # Handlers of the types of superposition that modify the segments, the rest are ignored
+    _superposition_handlers = {
+        SuperpositionType.STARTS_BEFORE_AND_OVERLAPS: _handle_starts_before,
+        SuperpositionType.STARTS_AFTER_AND_OVERLAPS: _handle_starts_after,
+        SuperpositionType.IS_CONTAINED: _handle_contained,
+    }
 
     def filter_amount(self, reducible_classes = None, target_count = None):
         if reducible_classes and target_count:
@@ -9,6 +9,11 @@ Created on Fri Aug 02 10:10:48 2024
     EfficientAT model """
 
 import yaml
+try:
+    # libyaml emitter, much faster than the pure Python one
+    from yaml import CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeDumper
 import logging
 from pathlib import Path
 import os
@@ -27,32 +32,127 @@ import seaborn as sns
 import pandas as pd
 from typing import Tuple, Dict, Union
 import librosa
+import random
+import functools
+import copy
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 
 from .utils import AugmentMelSTFT, EffATWrapper, process_audio_for_inference, LibrosaSpec,save_confusion_matrix
 from models.effat_repo.models.mn.model import get_model as get_mn
 from models.effat_repo.models.dymn.model import get_model as get_dymn
 
-logging.basicConfig(level=logging.INFO)
-
 logger = logging.getLogger(__name__)
 
-handler = logging.FileHandler("log.log")
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-handler.setFormatter(formatter)
-logger.addHandler(handler)
+
+def setup_logging() -> None:
+    """Configures the logging of this module: INFO level on the console and a copy of the messages in log.log.
+    It is meant to be called from the scripts, so importing the module does not open the log file.
+    """
+    logging.basicConfig(level=logging.INFO)
+    if not logger.handlers:
+        handler = logging.FileHandler("log.log")
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+
+@functools.lru_cache(maxsize=4)
+def _load_pretrained(name_model: str) -> nn.Module:
+    """Loads a pretrained EfficientAT model (mn or dymn depending on the name). The models are cached, so building
+    several EffAtModel with the same model_name (e.g. in a sweep) does not load the weights again. The cached
+    models must not be modified, copy them before use.
+
+    Args:
+        name_model (str): The name of the pretrained model.
+
+    Returns:
+        nn.Module: The pretrained model.
+    """
+    if "dy" not in name_model:
+        return get_mn(pretrained_name=name_model)
+    return get_dymn(pretrained_name=name_model)
+
+
+def _cpu_copy(obj):
+    """Copies the tensors of a (nested) state dict to the CPU.
+
+    Args:
+        obj: A state dict, or any of its values.
+
+    Returns:
+        The same structure with copies of the tensors in CPU.
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: _cpu_copy(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_cpu_copy(v) for v in obj)
+    return obj
+
+
+def _write_checkpoint(payload: dict, path: Path) -> None:
+    """Saves a checkpoint through a temporary file, so a partially written model.pth is never left behind.
+
+    Args:
+        payload (dict): The state dicts to be saved.
+        path (Path): Where the checkpoint is saved.
+    """
+    tmp_path = path.with_name(path.name + ".tmp")
+    torch.save(payload, tmp_path, pickle_protocol=5)
+    os.replace(tmp_path, path)
+
+
+def _write_json(obj: dict, path: Path) -> None:
+    """Writes a dict as a compact JSON file with a single write. json.dumps uses the C encoder in one shot,
+    while json.dump encodes with the pure Python iterencode and writes every piece separately.
+
+    Args:
+        obj (dict): The content of the file.
+        path (Path): Where the file is written.
+    """
+    with open(path, "w") as f:
+        f.write(json.dumps(obj, separators=(",", ":")))
+
+
+def _list_class_files(path_classes: str) -> Dict[str, list]:
+    """Lists the files of each class folder inside a split folder (train or test) in a single os.scandir pass per folder.
+
+    Args:
+        path_classes (str): The split folder, with one subfolder per class.
+
+    Returns:
+        Dict[str, list]: The paths to the files of each class.
+    """
+    class_files = {}
+    with os.scandir(path_classes) as classes:
+        for entry in classes:
+            if entry.is_dir():
+                with os.scandir(entry.path) as files:
+                    class_files[entry.name] = [file.path for file in files if file.is_file()]
+    return class_files
+
 
 class HelperDataset(Dataset):
     def __init__(self, path_data: str, sr: float, duration: float,
-                 mel, train: bool = True, label_to_idx: dict = None):
+                 mel, train: bool = True, label_to_idx: dict = None, device: str = "cpu", return_waveform: bool = False,
+                 cache_dir: str = None, class_files: Dict[str, list] = None):
         """The constructor for the HelperDataset class. A class used to feed the data generated by EcossDataset class into EffAtModel class.
 
         Args:
             path_data (str): Path to the folder where train and tets folder are located
             sr (float): The sampling rate of the generated dataset
             duration (float): The duration of the generated dataset clips
-            mel (AugmentMelSTFT): The AugmentMelSTFT instance
+            mel (AugmentMelSTFT): The AugmentMelSTFT instance (not used if return_waveform is True)
             train (bool, optional): If True, it loads the data inside the train folder, if False, loads the test folder. Defaults to True.
             label_to_idx (dict, optional): Dictionary that associated a class to a integer. Defaults to None.
+            device (str, optional): The device where the mel is computed. Defaults to "cpu".
+            return_waveform (bool, optional): If True, the mel is not computed and the waveforms are returned, cropped or padded with zeros to the duration of the clips
+                so they can be batched and sent to the mel on the GPU. Defaults to False.
+            cache_dir (str, optional): If given, the items (waveforms or mels) are computed once and stored in a float16 .npy file inside this folder,
+                which is memory mapped and read in the next epochs and runs. Defaults to None (no cache).
+            class_files (Dict[str, list], optional): The files of each class of the split, if they were already listed (see EffAtModel._class_index).
+                Defaults to None (the split folder is scanned).
         """
         self.train = train
         if self.train == True:
@@ -63,7 +163,12 @@ class HelperDataset(Dataset):
         self.sr = sr
         self.duration = duration
         self.mel = mel
-        self.classes = os.listdir(self.path_data)
+        self.device = device
+        self.return_waveform = return_waveform
+        self.num_frames = int(self.sr * self.duration)
+        if class_files is None:
+            class_files = _list_class_files(self.path_data)
+        self.classes = list(class_files)
         data, labels = [], []
 
         if not label_to_idx:
@@ -71,14 +176,14 @@ class HelperDataset(Dataset):
         else:
             self.label_to_idx = label_to_idx
 
-        for cls in self.classes:
-            files = [os.path.join(self.path_data, cls, file) for file in os.listdir(os.path.join(self.path_data, cls))]
-            for file in files:
-                data.append((file, self.label_to_idx[cls]))
-                labels.append(self.label_to_idx[cls])
+        for cls, files in class_files.items():
+            idx = self.label_to_idx[cls]
+            data.extend((file, idx) for file in files)
+            labels.extend([idx] * len(files))
         
         self.data = data
-        self.labels = labels
+        self.labels = np.array(labels, dtype=np.int64)
+        self.cache = self._build_cache(cache_dir) if cache_dir else None
 
 
     def __len__(self):
@@ -87,8 +192,69 @@ class HelperDataset(Dataset):
 
     def __getitem__(self, index):
         path_audio, label = self.data[index]
-        y, _ = torchaudio.load(path_audio)
-        return self.mel(y), label, path_audio
+        if self.cache is not None:
+            return torch.from_numpy(self.cache[index].astype(np.float32)), label, path_audio
+        return self._load_item(path_audio), label, path_audio
+
+
+    def _load_item(self, path_audio: str) -> torch.Tensor:
+        """Loads an audio file and returns the waveform (if return_waveform) or its mel.
+
+        Args:
+            path_audio (str): The path to the audio file.
+
+        Returns:
+            torch.Tensor: The waveform of shape (1, n_samples) or the mel of the file.
+        """
+        # Only the frames of one clip are decoded
+        y, _ = torchaudio.load(path_audio, frame_offset=0, num_frames=self.num_frames, backend="soundfile")
+        if self.return_waveform:
+            return nn.functional.pad(y, (0, self.num_frames - y.shape[-1]))
+        return self.mel(y.to(self.device))
+
+
+    def _build_cache(self, cache_dir: str) -> Union[np.ndarray, None]:
+        """Computes the items of all the files once and stores them in a memory mapped float16 .npy file. The name of the file
+        is a hash of the files (with their modification time and size), the clip length and the mel parameters, so any change in them generates a new cache.
+
+        Args:
+            cache_dir (str): The folder where the cache is stored.
+
+        Returns:
+            np.ndarray: The memory mapped items, or None if the items do not have the same shape and can not be cached.
+        """
+        mel_params = {} if self.return_waveform else {k: v for k, v in vars(self.mel).items()
+                                                      if isinstance(v, (bool, int, float, str)) and k not in ("training", "device")}
+        # The modification time and size of the files are included so regenerated data does not reuse an old cache
+        files = [(path, stat.st_mtime, stat.st_size) for path, stat in ((path, os.stat(path)) for path, _ in self.data)]
+        key = json.dumps([files, self.num_frames, self.return_waveform,
+                          type(self.mel).__name__, mel_params], sort_keys=True)
+        split = 'train' if self.train else 'test'
+        cache_path = os.path.join(cache_dir, f"{split}_{hashlib.sha1(key.encode()).hexdigest()}.npy")
+
+        if not os.path.isfile(cache_path):
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = cache_path + '.tmp.npy'
+            cache = None
+            for index, (path_audio, _) in enumerate(tqdm(self.data, desc=f"Caching {split} data")):
+                item = self._load_item(path_audio).cpu().numpy()
+                if cache is None:
+                    cache = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float16, shape=(len(self.data),) + item.shape)
+                elif item.shape != cache.shape[1:]:
+                    logger.warning("The %s data can not be cached, %s has shape %s instead of %s", split, path_audio, item.shape, cache.shape[1:])
+                    del cache
+                    os.remove(tmp_path)
+                    return None
+                cache[index] = item
+            if cache is None:
+                return None
+            cache.flush()
+            del cache
+            os.replace(tmp_path, cache_path)
+
+        logger.info("Using the %s data cached in %s", split, cache_path)
+        # The positions of the cache follow the order of self.data
+        return np.load(cache_path, mmap_mode='r')
 
 
 class EffAtModel():
@@ -102,22 +268,45 @@ class EffAtModel():
         """
         self.yaml = yaml_content
         self.data_path = data_path
-
-        if self.yaml["augmentmel"]:
-            self.mel = AugmentMelSTFT(freqm=self.yaml["freqm"],
-                                    timem=self.yaml["freqm"],
+        # Configuration values read in the training and data loading loops
+        self.augmentmel = yaml_content["augmentmel"]
+        self.sr = yaml_content["sr"]
+        self.duration = yaml_content["duration"]
+        self.batch_size = yaml_content["batch_size"]
+        self.n_epochs = yaml_content["n_epochs"]
+        self.patience = yaml_content["patience"]
+        self.freqm = yaml_content["freqm"]
+        self.timem = yaml_content.get("timem", yaml_content["freqm"])
+        # Audio files of each class in the train folder, listed once for the training dataset and plot_processed_data
+        self._class_index = self._build_class_index()
+        # Mels of the files plotted by plot_processed_data, so plotting them again does not recompute them
+        self._cached_mel = functools.lru_cache(maxsize=64)(self._compute_mel)
+        # The checkpoints are written in a background thread during train, one at a time
+        self._ckpt_executor = None
+        self._ckpt_future = None
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        # Mixed precision is only used on GPU, it can be disabled in the configuration (amp)
+        self.amp = self.device == "cuda" and self.yaml.get("amp", True)
+        self.eval_dtype = torch.bfloat16 if self.amp and torch.cuda.is_bf16_supported() else torch.float16
+
+        # The mel is computed on the GPU when possible, LibrosaSpec always works on CPU
+        if self.augmentmel:
+            self.mel_device = self.device
+            self.mel = AugmentMelSTFT(freqm=self.freqm,
+                                    timem=self.timem,
                                     n_mels=self.yaml["n_mels"],
-                                    sr=self.yaml["sr"],
+                                    sr=self.sr,
                                     win_length=self.yaml["win_length"],
                                     hopsize=self.yaml["hopsize"],
                                     n_fft=self.yaml["n_fft"],
                                     fmin=self.yaml["fmin"],
                                     fmax=self.yaml["fmax"],
                                     fmax_aug_range=self.yaml["fmax_aug_range"],
-                                    fmin_aug_range=self.yaml["fmin_aug_range"])
+                                    fmin_aug_range=self.yaml["fmin_aug_range"]).to(self.mel_device)
         else:
+            self.mel_device = "cpu"
             self.mel = LibrosaSpec(mel=self.yaml["melspec"],
-                                   sr=self.yaml["sr"],
+                                   sr=self.sr,
                                    win_length=self.yaml["win_length"],
                                    hopsize=self.yaml["hopsize"],
                                    n_fft=self.yaml["n_fft"],
@@ -125,64 +314,186 @@ class EffAtModel():
 
         self.name_model = self.yaml["model_name"]
         self.num_classes = num_classes
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        logger.info(f"The device used for training is {self.device}")
+        logger.info("The device used for training is %s", self.device)
 
-        if "dy" not in self.name_model:
-            model = get_mn(pretrained_name=self.name_model)
-        else:
-            model = get_dymn(pretrained_name=self.name_model)
+        # The pretrained model is loaded once per name, each EffAtModel trains its own copy
+        model = copy.deepcopy(_load_pretrained(self.name_model))
 
         # Using the wrapper to modify the last layer and moving to device
         model = EffATWrapper(num_classes=num_classes, model=model, freeze=self.yaml["freeze"])
-        model.to(self.device)
+        # channels_last lets cuDNN use its NHWC convolution kernels
+        model = model.to(self.device, memory_format=torch.channels_last)
+        # Uncompiled model used inside the training step, which is compiled as a whole
+        self._step_model = model
         if self.yaml["compile"]:
-            model = torch.compile(model,mode = "reduce-overhead")
+            model = torch.compile(model, mode=self.yaml.get("compile_mode", "max-autotune"))
         
         self.model = model
+        # With compile, the model and the loss of a training step are compiled together so they can be fused. The mel stays
+        # in eager mode (see _model_inputs): AugmentMelSTFT draws random Python ints that would break the graph and force recompiles
+        self._train_step = torch.compile(self._forward_step, mode=self.yaml.get("compile_mode", "max-autotune"), dynamic=False) if self.yaml["compile"] else self._forward_step
+
+
+    def _num_workers(self) -> int:
+        """Returns the number of DataLoader workers, set in the configuration (num_workers) or half of the CPUs by default.
+
+        Returns:
+            int: The number of workers.
+        """
+        return self.yaml.get("num_workers", (os.cpu_count() or 2) // 2)
+
+
+    def _dataloader_kwargs(self, mel: nn.Module, mel_device: str) -> dict:
+        """Returns the DataLoader arguments used to load the audios and compute their mels in parallel with the model.
+        The number of workers and the prefetch factor can be set in the configuration (num_workers and prefetch_factor).
+
+        Args:
+            mel (nn.Module): The mel used inside HelperDataset (see _dataset_mel), None if it returns the waveforms.
+            mel_device (str): The device where that mel is computed.
+
+        Returns:
+            dict: The keyword arguments for torch.utils.data.DataLoader.
+        """
+        # CUDA tensors can not be pinned, the batches are only pinned when the dataset returns CPU tensors
+        # (LibrosaSpec computes on CPU but returns its output on its own device)
+        items_device = "cpu" if mel is None else getattr(mel, "device", mel_device)
+        kwargs = {"num_workers": self._num_workers(),
+                  "pin_memory": str(items_device) == "cpu" and self.device == "cuda"}
+        if kwargs["num_workers"] > 0:
+            kwargs["persistent_workers"] = True
+            kwargs["prefetch_factor"] = self.yaml.get("prefetch_factor", 4)
+        return kwargs
+
+
+    def _dataset_mel(self) -> Tuple[nn.Module, str]:
+        """Returns the mel to be used inside HelperDataset and the device where it is computed. CUDA can not be used
+        in the DataLoader workers, so when there are workers they get a CPU copy of the mel.
+        AugmentMelSTFT is not used by the workers: they return the waveforms and the mel is computed by batches in the main process (see _model_inputs).
+
+        Returns:
+            Tuple[nn.Module, str]: The mel and its device.
+        """
+        if self.augmentmel:
+            return None, "cpu"
+        if self._num_workers() == 0:
+            return self.mel, self.mel_device
+        mel = copy.deepcopy(self.mel).cpu()
+        if isinstance(mel, LibrosaSpec):
+            mel.device = "cpu"
+        return mel, "cpu"
+
+
+    def _cache_dir(self, path_data: str) -> Union[str, None]:
+        """Returns the folder where HelperDataset caches the data, if enabled in the configuration (cache_data).
+
+        Args:
+            path_data (str): The path where the train and test folders are located.
+
+        Returns:
+            str: The cache folder, or None if the data is not cached.
+        """
+        return os.path.join(path_data, "cache") if self.yaml.get("cache_data", False) else None
+
+
+    def _forward_step(self, inputs: torch.Tensor, labels: torch.Tensor, criterion: nn.Module) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Forward pass of a training step, from the mels already on the device to the loss.
+
+        Args:
+            inputs (torch.Tensor): The mels of the batch (see _model_inputs)
+            labels (torch.Tensor): The labels of the batch
+            criterion (nn.Module): The loss function
+
+        Returns:
+            Tuple[torch.Tensor, torch.Tensor]: The outputs of the model and the loss
+        """
+        outputs, _ = self._step_model(inputs)
+        outputs = outputs.reshape(outputs.size(0), -1)
+        return outputs, criterion(outputs, labels)
 
 
-    def load_aux_datasets(self) -> Tuple[DataLoader, DataLoader, Dict[str, int]]:
+    def _model_inputs(self, inputs: torch.Tensor) -> torch.Tensor:
+        """Moves a batch from the DataLoader to the device and, if it contains waveforms, computes their mels on it.
+
+        Args:
+            inputs (torch.Tensor): The batch, waveforms of shape (batch, 1, n_samples) when using AugmentMelSTFT or mels otherwise.
+
+        Returns:
+            torch.Tensor: The mels, a tensor of shape (batch, 1, n_mels, n_frames) in channels_last memory format
+        """
+        inputs = inputs.to(self.device, non_blocking=True)
+        if self.augmentmel:
+            inputs = self.mel(inputs.squeeze(1)).unsqueeze(1)
+        return inputs.contiguous(memory_format=torch.channels_last)
+
+
+    def _autocast(self, dtype: torch.dtype) -> torch.autocast:
+        """Returns the autocast context used for the forward passes, a no-op when mixed precision is disabled.
+
+        Args:
+            dtype (torch.dtype): The lower precision type (torch.float16 for training, self.eval_dtype for evaluation).
+
+        Returns:
+            torch.autocast: The autocast context manager.
+        """
+        return torch.autocast(device_type=self.device, dtype=dtype, enabled=self.amp)
+
+
+    def load_aux_datasets(self) -> Tuple[DataLoader, DataLoader, Dict[str, int], Union[torch.Tensor, None]]:
         """Function that uses the HelperDataset class in order to generate the pytorch dataloaders to model the data.
-        It applies WeightedRandomSampler on the train_dataloader to prevent overfitting due to unbalaced classes.
+        To prevent overfitting due to unbalaced classes, it applies WeightedRandomSampler on the train_dataloader or, if class_balancing
+        is "loss" in the configuration, it shuffles the training set and returns class weights for the loss.
 
         Returns:
-            train_dataloader (torch.utils.data.DataLoader):  DataLoader for the training dataset, with weighted sampling applied.
+            train_dataloader (torch.utils.data.DataLoader):  DataLoader for the training dataset, with weighted sampling or shuffling applied.
             test_dataloader (torch.utils.data.DataLoader): DataLoader for the testing dataset, without weighted sampling.
             label_to_idx (dict): A dictionary mapping each label in the training dataset to its corresponding index.
+            class_weights (torch.Tensor): The weight of each class in the loss, None when using the WeightedRandomSampler.
         """
-        dataset_train = HelperDataset(path_data = self.data_path, sr=self.yaml["sr"],
-                                      duration=self.yaml["duration"], mel=self.mel,
+        mel, mel_device = self._dataset_mel()
+        dataset_train = HelperDataset(path_data = self.data_path, sr=self.sr,
+                                      duration=self.duration, mel=mel,
                                       train=True,
-                                      label_to_idx=None)
+                                      label_to_idx=None, device=mel_device, return_waveform=self.augmentmel,
+                                      cache_dir=self._cache_dir(self.data_path), class_files=self._class_index or None)
         logger.debug("Training dataset obtained")
 
-        dataset_test = HelperDataset(path_data = self.data_path, sr=self.yaml["sr"],
-                                     duration=self.yaml["duration"], mel=self.mel,
+        dataset_test = HelperDataset(path_data = self.data_path, sr=self.sr,
+                                     duration=self.duration, mel=mel,
                                      train=False,
-                                     label_to_idx=dataset_train.label_to_idx)
+                                     label_to_idx=dataset_train.label_to_idx, device=mel_device, return_waveform=self.augmentmel,
+                                     cache_dir=self._cache_dir(self.data_path))
         logger.debug("Testing dataset obtained")
 
-        # Create the WeightedRandomSampler for unbalanced datasets
         train_labels = dataset_train.labels
         logger.debug("Training labels obtained")
-        class_counts = np.bincount(train_labels)
-        logger.debug("Class counts obtained")
-        class_weights = 1. / class_counts
-        samples_weights = class_weights[train_labels]
-        samples_weights = torch.FloatTensor(samples_weights)
-        class_weights = torch.FloatTensor(class_weights).to(self.device)
+        # The compiled training step is specialized to the batch size, the last smaller batch is dropped instead of compiling it again
+        drop_last = self.yaml["compile"] and len(dataset_train) >= self.batch_size
+        # Seeded so the sampled batches can be reproduced (seed in the configuration)
+        generator = torch.Generator().manual_seed(self.yaml.get("seed", 27))
+
+        if self.yaml.get("class_balancing", "sampler") == "loss":
+            # Each class weighs the inverse of its frequency in the loss and the training set is simply shuffled
+            class_counts = np.bincount(train_labels, minlength=len(dataset_train.label_to_idx))
+            class_weights = np.divide(1., class_counts, out=np.zeros(len(class_counts)), where=class_counts > 0)
+            class_weights = torch.as_tensor(class_weights, dtype=torch.float32, device=self.device)
+            train_dataloader = DataLoader(dataset=dataset_train, shuffle=True, generator=generator, batch_size=self.batch_size, drop_last=drop_last, **self._dataloader_kwargs(mel, mel_device))
+        else:
+            # Create the WeightedRandomSampler for unbalanced datasets
+            _, sample_classes, class_counts = np.unique(train_labels, return_inverse=True, return_counts=True)
+            logger.debug("Class counts obtained")
+            samples_weights = torch.as_tensor((1. / class_counts).astype(np.float32)[sample_classes])
+            class_weights = None
 
-        logger.debug("Everything set for the WeightedRandomSampler")
+            logger.debug("Everything set for the WeightedRandomSampler")
 
-        train_sampler = WeightedRandomSampler(weights=samples_weights, num_samples=len(samples_weights), replacement=True)
-        logger.debug("WRS obtained")
+            train_sampler = WeightedRandomSampler(weights=samples_weights, num_samples=len(samples_weights), replacement=True, generator=generator)
+            logger.debug("WRS obtained")
+            train_dataloader = DataLoader(dataset=dataset_train, sampler=train_sampler, batch_size=self.batch_size, drop_last=drop_last, **self._dataloader_kwargs(mel, mel_device))
 
-        train_dataloader = DataLoader(dataset=dataset_train, sampler=train_sampler, batch_size=self.yaml["batch_size"])
-        test_dataloader = DataLoader(dataset=dataset_test, batch_size=self.yaml["batch_size"])  # Not doing weighted samples for testing
+        test_dataloader = DataLoader(dataset=dataset_test, batch_size=self.batch_size, **self._dataloader_kwargs(mel, mel_device))  # Not doing weighted samples for testing
         logger.debug("DLs obtained")
 
-        return train_dataloader, test_dataloader, dataset_train.label_to_idx
+        return train_dataloader, test_dataloader, dataset_train.label_to_idx, class_weights
 
 
     def train(self, results_folder: str) -> None:
@@ -193,134 +504,152 @@ class EffAtModel():
         """
         # Saving the configuration.yaml inside the results folder
         self.results_folder = Path(results_folder)
-        logging.info(f"Training EffAT")
+        logger.info("Training EffAT")
         output_config_path = self.results_folder / 'configuration.yaml'
-        logging.info(f"Saving configuration in {output_config_path}")
+        logger.info("Saving configuration in %s", output_config_path)
         with open(str(output_config_path), 'w') as outfile:
-            yaml.dump(self.yaml, outfile, default_flow_style=False)
-        logging.info(f"Config params:\n {self.yaml}")
+            yaml.dump(self.yaml, outfile, Dumper=SafeDumper, default_flow_style=False)
+        logger.info("Config params:\n %s", self.yaml)
 
         # Begin the training
         self.model.train()
-        logging.info("Model set to train mode")
-        if self.yaml["optimizer"].lower() == "adam":
-            optimizer = optim.Adam(self.model.parameters(), lr=self.yaml["lr"])
-        else:
-            optimizer = optim.SGD(self.model.parameters(), lr=self.yaml["lr"])
-
-        criterion = nn.CrossEntropyLoss()
-        logging.info("Criterion and optimizer selected")
+        logger.info("Model set to train mode")
+        optimizer_class = optim.Adam if self.yaml["optimizer"].lower() == "adam" else optim.SGD
+        try:
+            # The fused implementation updates all the parameters in a few kernels instead of one per tensor (CUDA only)
+            optimizer = optimizer_class(self.model.parameters(), lr=self.yaml["lr"], fused=self.device == "cuda")
+        except TypeError:  # torch versions without fused optimizers
+            optimizer = optimizer_class(self.model.parameters(), lr=self.yaml["lr"])
+
+        scaler = torch.amp.GradScaler("cuda", enabled=self.amp)
+        logger.info("Optimizer selected")
         best_accuracy = 0.0
         epochs_without_improvement = 0
 
         train_accs, test_accs = [], []
         train_losses, test_losses = [], []
 
-        train_dataloader, test_dataloader, label_encoder = self.load_aux_datasets()
-        logging.info("Dataloaders obtained")
-        for i in tqdm(range(self.yaml["n_epochs"]), desc="Epoch"):
-            self.model.train()
-            running_loss = 0.0
-            batch_count = 0
-            correct = 0
-            total = 0
-            all_preds = []
-            all_labels = []
-
-            for inputs, labels, _ in tqdm(train_dataloader, desc="Train"):
-                inputs, labels = inputs.to(self.device), labels.to(self.device)
-                optimizer.zero_grad()
-
-                # Forward pass
-                outputs, _ = self.model(inputs)
-                outputs = outputs.squeeze()
-
-                loss = criterion(outputs, labels)
-
-                # Backward pass and optimization
-                loss.backward()
-                optimizer.step()
-
-                running_loss += loss.item()
-                batch_count += 1
-
-                 # Calculate training accuracy
-                _, predicted = torch.max(outputs, 1)
-                total += labels.size(0)
-                correct += (predicted == labels).sum().item()
-                all_preds.extend(predicted.cpu().numpy())
-                all_labels.extend(labels.cpu().numpy())
-
-            epoch_loss = running_loss / batch_count
-            train_accuracy = 100 * correct / total
-            train_f1 = f1_score(all_labels, all_preds, average='macro')
-
-            # Evaluation
-            self.model.eval()
-            test_loss = 0.0
-            batch_count = 0
-            correct = 0
-            total = 0
-            all_preds = []
-            all_labels = []
-
-            with torch.no_grad():
-                for inputs, labels, _ in tqdm(test_dataloader, desc="Test"):
-                    inputs, labels = inputs.to(self.device), labels.to(self.device)
-                    outputs, _ = self.model(inputs)
-                    outputs = outputs.squeeze()
-
-                    loss = criterion(outputs, labels)
-                    test_loss += loss.item()
+        train_dataloader, test_dataloader, label_encoder, class_weights = self.load_aux_datasets()
+        logger.info("Dataloaders obtained")
+        criterion = nn.CrossEntropyLoss(weight=class_weights, label_smoothing=self.yaml.get("label_smoothing", 0.0))
+        # The test loss stays a plain cross entropy so it can be compared between runs with different balancing or smoothing
+        test_criterion = nn.CrossEntropyLoss()
+        logger.info("Criterion selected")
+        self._ckpt_executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            for i in tqdm(range(self.n_epochs), desc="Epoch"):
+                self.model.train()
+                # The metrics are accumulated on the device and only copied to the CPU at the end of the epoch
+                running_loss = torch.zeros((), device=self.device)
+                batch_count = 0
+                correct = torch.zeros((), dtype=torch.long, device=self.device)
+                total = 0
+                all_preds = torch.empty(len(train_dataloader.sampler), dtype=torch.long, device=self.device)
+                all_labels = torch.empty_like(all_preds)
+
+                for inputs, labels, _ in tqdm(train_dataloader, desc="Train"):
+                    inputs, labels = self._model_inputs(inputs), labels.to(self.device, non_blocking=True)
+                    optimizer.zero_grad(set_to_none=True)
+
+                    # Forward pass
+                    with self._autocast(torch.float16):
+                        outputs, loss = self._train_step(inputs, labels, criterion)
+
+                    # Backward pass and optimization, the loss is scaled to avoid float16 gradients underflowing
+                    scaler.scale(loss).backward()
+                    scaler.step(optimizer)
+                    scaler.update()
+
+                    running_loss += loss.detach()
                     batch_count += 1
 
+                     # Calculate training accuracy
                     _, predicted = torch.max(outputs, 1)
                     total += labels.size(0)
-
-                    correct += (predicted == labels).sum().item()
-                    all_preds.extend(predicted.cpu().numpy())
-                    all_labels.extend(labels.cpu().numpy())
-
-
-            avg_test_loss = test_loss / batch_count
-            test_accuracy = 100 * correct / total
-            test_f1 = f1_score(all_labels, all_preds, average='macro')
-
-            train_losses.append(epoch_loss)
-            test_losses.append(avg_test_loss)
-            train_accs.append(train_accuracy)
-            test_accs.append(test_accuracy)
-
-            logging.info(f"Epoch {i}: Train loss -> {epoch_loss}, test loss -> {avg_test_loss}, train accuracy -> {train_accuracy}, test accuracy -> {test_accuracy}")
-
-            if test_accuracy > best_accuracy:
-                best_accuracy = test_accuracy
-                epochs_without_improvement = 0  # Reset counter if we see improvement
-                logging.info(f"New best testing accuracy: {best_accuracy}")
-
-                # Compute the confusion matrix in the testing dataset (each time it saves another better model)
-                cm = confusion_matrix(all_labels, all_preds)
-
-                # Saving weights, results and curves
-                self.plot_results(train_losses, test_losses, train_accs, test_accs)
-                ordered_labels = [k for k, v in sorted(label_encoder.items(), key=lambda item: item[1])]
-                save_confusion_matrix(unique_labels=ordered_labels,exp_folder=self.results_folder,true_labels=all_labels,predicted_labels=all_preds,title="cm")
-                self.plot_cm(cm)
-                self.save_weights(optimizer)
-                metrics = {"train_acc": train_accuracy,
-                           "test_acc": test_accuracy,
-                           "train_f1": train_f1,
-                           "test_f1": test_f1}
-
-                self.save_results(label_encoder, metrics)
-
-            else:
-                epochs_without_improvement += 1
-                logging.info(f"No improvement for {epochs_without_improvement} epoch(s).")
-
-            if epochs_without_improvement >= self.yaml["patience"]:
-                logging.info(f"Early stopping triggered after {i+1} epochs.")
-                break
+                    correct += (predicted == labels).sum()
+                    all_preds[total - labels.size(0):total] = predicted
+                    all_labels[total - labels.size(0):total] = labels
+
+                epoch_loss = running_loss.item() / batch_count
+                train_accuracy = 100 * correct.item() / total
+                all_preds, all_labels = all_preds[:total].cpu().numpy(), all_labels[:total].cpu().numpy()
+                train_f1 = f1_score(all_labels, all_preds, average='macro')
+
+                # Evaluation
+                self.model.eval()
+                test_loss = torch.zeros((), device=self.device)
+                batch_count = 0
+                correct = torch.zeros((), dtype=torch.long, device=self.device)
+                total = 0
+                all_preds = torch.empty(len(test_dataloader.sampler), dtype=torch.long, device=self.device)
+                all_labels = torch.empty_like(all_preds)
+
+                with torch.inference_mode(), self._autocast(self.eval_dtype):
+                    for inputs, labels, _ in tqdm(test_dataloader, desc="Test"):
+                        inputs, labels = self._model_inputs(inputs), labels.to(self.device, non_blocking=True)
+                        outputs, _ = self.model(inputs)
+                        outputs = outputs.reshape(outputs.size(0), -1)
+
+                        loss = test_criterion(outputs, labels)
+                        test_loss += loss
+                        batch_count += 1
+
+                        _, predicted = torch.max(outputs, 1)
+                        total += labels.size(0)
+
+                        correct += (predicted == labels).sum()
+                        all_preds[total - labels.size(0):total] = predicted
+                        all_labels[total - labels.size(0):total] = labels
+
+
+                avg_test_loss = test_loss.item() / batch_count
+                test_accuracy = 100 * correct.item() / total
+                all_preds, all_labels = all_preds[:total].cpu().numpy(), all_labels[:total].cpu().numpy()
+                test_f1 = f1_score(all_labels, all_preds, average='macro')
+
+                train_losses.append(epoch_loss)
+                test_losses.append(avg_test_loss)
+                train_accs.append(train_accuracy)
+                test_accs.append(test_accuracy)
+
+                logger.info("Epoch %s: Train loss -> %s, test loss -> %s, train accuracy -> %s, test accuracy -> %s", i, epoch_loss, avg_test_loss, train_accuracy, test_accuracy)
+
+                if test_accuracy > best_accuracy:
+                    best_accuracy = test_accuracy
+                    epochs_without_improvement = 0  # Reset counter if we see improvement
+                    logger.info("New best testing accuracy: %s", best_accuracy)
+
+                    # Compute the confusion matrix in the testing dataset (each time it saves another better model)
+                    cm = confusion_matrix(all_labels, all_preds)
+
+                    # Saving weights, results and curves
+                    self.plot_results(train_losses, test_losses, train_accs, test_accs)
+                    ordered_labels = [k for k, v in sorted(label_encoder.items(), key=lambda item: item[1])]
+                    save_confusion_matrix(unique_labels=ordered_labels,exp_folder=self.results_folder,true_labels=all_labels,predicted_labels=all_preds,title="cm")
+                    self.plot_cm(cm)
+                    self.save_weights(optimizer)
+                    metrics = {"train_acc": train_accuracy,
+                               "test_acc": test_accuracy,
+                               "train_f1": train_f1,
+                               "test_f1": test_f1}
+
+                    self.save_results(label_encoder, metrics)
+
+                else:
+                    epochs_without_improvement += 1
+                    logger.info("No improvement for %s epoch(s).", epochs_without_improvement)
+
+                if epochs_without_improvement >= self.patience:
+                    logger.info("Early stopping triggered after %s epochs.", i+1)
+                    break
+
+        finally:
+            # The last best model has to be on disk before returning (e.g. to test it), also if the training fails
+            try:
+                self.wait_checkpoint()
+            finally:
+                self._ckpt_executor.shutdown()
+                self._ckpt_executor = None
 
 
     def test(self, results_folder: str, path_model: str, path_data: str) -> None:
@@ -345,40 +674,44 @@ class EffAtModel():
         
         self.model.eval()
         self.mel.eval()
-        logger.info(f"Weights succesfully loaded into the model")
+        logger.info("Weights succesfully loaded into the model")
 
         # Get the mapping
         class_map_path = path_model.replace('model.pth', 'class_dict.json')
         with open(class_map_path, 'r') as f:
             class_map = json.load(f)
 
-        logger.info(f"The class mapping that will be used is {class_map}")
+        logger.info("The class mapping that will be used is %s", class_map)
 
         # Prepare the dataset
-        test_dataset = HelperDataset(path_data=path_data, sr=self.yaml["sr"],
-                                     duration=self.yaml["duration"], mel=self.mel, train=self.yaml["test_on_train"], label_to_idx=class_map)
-        test_dataloader = DataLoader(dataset=test_dataset, batch_size=self.yaml["batch_size"])
+        mel, mel_device = self._dataset_mel()
+        test_dataset = HelperDataset(path_data=path_data, sr=self.sr,
+                                     duration=self.duration, mel=mel, train=self.yaml["test_on_train"], label_to_idx=class_map, device=mel_device, return_waveform=self.augmentmel,
+                                     cache_dir=self._cache_dir(path_data))
+        test_dataloader = DataLoader(dataset=test_dataset, batch_size=self.batch_size, **self._dataloader_kwargs(mel, mel_device))
 
         logger.info("Dataset succesfully generated")
 
-        correct = 0
+        # The metrics are accumulated on the device and only copied to the CPU once all the batches are processed
+        correct = torch.zeros((), dtype=torch.long, device=self.device)
         total = 0
-        all_preds = []
-        all_labels = []
+        all_preds = torch.empty(len(test_dataloader.sampler), dtype=torch.long, device=self.device)
+        all_labels = torch.empty_like(all_preds)
 
-        with torch.no_grad():
+        with torch.inference_mode(), self._autocast(self.eval_dtype):
             for inputs, labels, _ in tqdm(test_dataloader, desc="Test"):
-                inputs, labels = inputs.to(self.device), labels.to(self.device)
+                inputs, labels = self._model_inputs(inputs), labels.to(self.device, non_blocking=True)
                 outputs, _ = self.model(inputs)
-                outputs = outputs.squeeze()
+                outputs = outputs.reshape(outputs.size(0), -1)
 
                 _, predicted = torch.max(outputs, 1)
                 total += labels.size(0)
-                correct += (predicted == labels).sum().item()
-                all_preds.extend(predicted.cpu().numpy())
-                all_labels.extend(labels.cpu().numpy())
+                correct += (predicted == labels).sum()
+                all_preds[total - labels.size(0):total] = predicted
+                all_labels[total - labels.size(0):total] = labels
 
-        test_accuracy = 100 * correct / total
+        test_accuracy = 100 * correct.item() / total
+        all_preds, all_labels = all_preds[:total].cpu().numpy(), all_labels[:total].cpu().numpy()
         test_f1 = f1_score(all_labels, all_preds, average='macro')
 
         metrics = {"test_acc": test_accuracy,
@@ -416,54 +749,72 @@ class EffAtModel():
         with open(class_map_path, 'r') as f:
             class_map = json.load(f)
         inverse_class_map = {v: k for k, v in class_map.items()}
+        class_names = list(class_map.keys())
+        # The embeddings are only stored if asked in the configuration (save_embeddings)
+        save_embeddings = self.yaml.get("save_embeddings", False)
 
         if os.path.isfile(path_data):
-            outs, embs = [], []
-            preds = {}
-            with torch.no_grad():
-                y, _ = process_audio_for_inference(path_audio=path_data,
-                                                    desired_sr=self.yaml["sr"],
-                                                    desired_duration=self.yaml["duration"])
-            
-                for i in tqdm(range(y.shape[1])):
-                    output, embeddings = self.model(self.mel(y[:, i]).unsqueeze(0).to(self.device))  # Saving embeddings but not necessary
-                    outs.append(output)
-                    softmax = nn.Softmax(dim=1)
-                    percentages = softmax(output)
-                    predictions = torch.argmax(percentages).item()
-                    preds[f"chunk_{i}"] = {
-                        'Predicted Class': inverse_class_map[predictions],
-                        'Confidence per class': {k: float(percentages.cpu().numpy()[0, idx]) for idx, k in enumerate(class_map.keys())}
-                    }
-                    embs.append(embeddings)
-
-            with open(self.results_folder / 'predictions.json', "w") as f:
-                json.dump(preds, f)
+            preds = self._predict_file(path_data, inverse_class_map, class_names,
+                                       path_embeddings=self.results_folder / 'embeddings.npy' if save_embeddings else None)
+            _write_json(preds, self.results_folder / 'predictions.json')
         
 
         elif os.path.isdir(path_data):
             all_files = [os.path.join(path_data, file) for file in os.listdir(path_data)]
-            with torch.no_grad():
-                for file in all_files:
-                    outs = []
-                    preds = {}
-                    y, _ = process_audio_for_inference(path_audio=file,
-                                                       desired_sr=self.yaml["sr"],
-                                                       desired_duration=self.yaml["duration"])
-            
-                    for i in tqdm(range(y.shape[1])):
-                        output, _ = self.model(self.mel(y[:, i]).unsqueeze(0).to(self.device))
-                        outs.append(output)
-                        softmax = nn.Softmax(dim=1)
-                        percentages = softmax(output)
-                        predictions = torch.argmax(percentages).item()
-                        preds[f"chunk_{i}"] = {
-                            'Predicted Class': inverse_class_map[predictions],
-                            'Confidence per class': {k: float(percentages.cpu().numpy()[0, idx]) for idx, k in enumerate(class_map.keys())}
-                        }
+            for file in tqdm(all_files):
+                name_file = os.path.splitext(os.path.basename(file))[0]
+                preds = self._predict_file(file, inverse_class_map, class_names,
+                                           path_embeddings=self.results_folder / f'embeddings_{name_file}.npy' if save_embeddings else None)
+                _write_json(preds, self.results_folder / f'predictions_{name_file}.json')
+
 
-                        with open(self.results_folder / f'predictions_{os.path.splitext(os.path.basename(file))[0]}.json', "w") as f:
-                            json.dump(preds, f)
+    def _predict_file(self, path_audio: str, inverse_class_map: Dict[int, str], class_names: list, path_embeddings: Path = None) -> dict:
+        """Predicts the class of every chunk of an audio file. The chunks are passed through the mel and the model
+        by batches (inference_batch_size in the configuration) instead of one by one.
+
+        Args:
+            path_audio (str): The path to the audio file
+            inverse_class_map (Dict[int, str]): The class of every index of the model outputs
+            class_names (list): The classes, ordered by their index
+            path_embeddings (Path, optional): If given, the embeddings of the chunks are saved there as a float16 .npy file. Defaults to None.
+
+        Returns:
+            dict: The predicted class and the confidence per class of every chunk
+        """
+        chunks, _ = process_audio_for_inference(path_audio=path_audio,
+                                                desired_sr=self.sr,
+                                                desired_duration=self.duration,
+                                                mono=True)  # (n_chunks, n_samples)
+        if self.augmentmel:
+            # A single copy of the whole file to the device, the batches are views of it
+            chunks = chunks.to(self.device, non_blocking=True)
+        outputs, embeddings = [], []
+        with torch.inference_mode(), self._autocast(self.eval_dtype):
+            for batch in torch.split(chunks, self.yaml.get("inference_batch_size", 64)):
+                if self.augmentmel:
+                    batch = batch.unsqueeze(1)
+                else:
+                    # LibrosaSpec normalizes over its whole input, so each chunk needs its own call
+                    batch = torch.stack([self.mel(chunk.unsqueeze(0)) for chunk in batch])
+                output, embedding = self.model(self._model_inputs(batch))
+                outputs.append(output)
+                if path_embeddings is not None:
+                    # Moved out of the GPU so long recordings do not keep all their embeddings in its memory
+                    embeddings.append(embedding.to("cpu", dtype=torch.float16))
+            percentages = torch.softmax(torch.cat(outputs).float(), dim=1)
+            predictions = percentages.argmax(dim=1).tolist()
+            percentages = percentages.tolist()
+
+        if path_embeddings is not None:
+            np.save(path_embeddings, torch.cat(embeddings).numpy())
+
+        preds = {}
+        for i, (prediction, confidences) in enumerate(zip(predictions, percentages)):
+            preds[f"chunk_{i}"] = {
+                'Predicted Class': inverse_class_map[prediction],
+                'Confidence per class': dict(zip(class_names, confidences))
+            }
+        return preds
 
 
 
@@ -514,10 +865,23 @@ class EffAtModel():
         Args:
             optimizer (Union[optim.Adam, optim.SGD]): The optimizer used for the train process.
         """
-        torch.save({
+        # The training keeps updating the tensors in place, so the checkpoint is a CPU copy taken now and written in the background
+        payload = _cpu_copy({
                 'model_state_dict': self.model.state_dict(),
                 'optimizer_state_dict': optimizer.state_dict()
-                }, self.results_folder / 'model.pth')
+                })
+        self.wait_checkpoint()
+        if self._ckpt_executor is None:  # Outside train there is no background writer
+            _write_checkpoint(payload, self.results_folder / 'model.pth')
+        else:
+            self._ckpt_future = self._ckpt_executor.submit(_write_checkpoint, payload, self.results_folder / 'model.pth')
+
+
+    def wait_checkpoint(self) -> None:
+        """Blocks until the checkpoint being written by save_weights, if any, is on disk."""
+        if self._ckpt_future is not None:
+            self._ckpt_future.result()
+            self._ckpt_future = None
 
 
     def save_results(self, label_encoder: dict, metrics: dict) -> None:
@@ -536,6 +900,74 @@ class EffAtModel():
             json.dump(metrics, json_file)
 
 
+    def _build_class_index(self) -> Dict[str, list]:
+        """Lists the audio files of each class in the train folder.
+
+        Returns:
+            Dict[str, list]: The paths to the audio files of each class. Empty if there is no train folder (e.g. for inference).
+        """
+        path_classes = os.path.join(self.data_path, "train")
+        if not os.path.isdir(path_classes):
+            return {}
+        return _list_class_files(path_classes)
+
+
+    def _batch_mel(self, wavs: list) -> torch.Tensor:
+        """Computes the mel spectrograms of several waveforms at once on the device of the mel.
+
+        Args:
+            wavs (list): The waveforms (1D tensors). The shorter ones are padded with zeros to the longest one.
+
+        Returns:
+            torch.Tensor: The mel spectrograms, a tensor of shape (n_wavs, n_mels, n_frames)
+        """
+        batch = nn.utils.rnn.pad_sequence(wavs, batch_first=True)
+        return self.mel(batch.to(self.mel_device, non_blocking=True))
+
+
+    def _load_clip(self, path: str) -> Tuple[torch.Tensor, int]:
+        """Loads the first clip (duration in the configuration) of an audio file with the soundfile backend,
+        the rest of the file is not decoded.
+
+        Args:
+            path (str): The path to the audio file.
+
+        Returns:
+            Tuple[torch.Tensor, int]: The waveform, a tensor of shape (n_channels, n_samples), and its sampling rate.
+        """
+        num_frames = int(self.sr * self.duration)
+        return torchaudio.load(path, frame_offset=0, num_frames=num_frames, backend="soundfile")
+
+
+    def _compute_mel(self, path: str) -> Tuple[torch.Tensor, int]:
+        """Loads an audio file and computes its mel spectrogram.
+
+        Args:
+            path (str): The path to the audio file.
+
+        Returns:
+            Tuple[torch.Tensor, int]: The mel spectrogram (on CPU) and the sampling rate of the file.
+        """
+        y, sr = self._load_clip(path)
+        return self.mel(y.to(self.mel_device)).cpu(), sr
+
+
+    def _mel_for(self, path: str, augment: bool) -> Tuple[torch.Tensor, int]:
+        """Returns the mel spectrogram and sampling rate of an audio file, reusing the ones already computed
+        unless the mel is randomly augmented.
+
+        Args:
+            path (str): The path to the audio file.
+            augment (bool): If True, the mel is being augmented.
+
+        Returns:
+            Tuple[torch.Tensor, int]: The mel spectrogram (on CPU) and the sampling rate of the file.
+        """
+        if augment and self.augmentmel:
+            return self._compute_mel(path)
+        return self._cached_mel(path)
+
+
     def plot_processed_data(self, augment: bool = True) -> None:
         """This function will plot a random mel spectrogram per class available for the training
 
@@ -543,61 +975,58 @@ class EffAtModel():
         Args:
             augment (bool, optional): If se to true, the mel will be augmented. Defaults to True.
         """
-        path_classes = os.path.join(self.data_path, "train")
-        available_classes = os.listdir(path_classes)
+        class_files = self._class_index
 
         if augment == False:
             self.mel.eval()
 
-        if self.yaml["augmentmel"]:
-            for av_class in available_classes:
-                path_wavs = os.path.join(path_classes, av_class)
-                wav_to_plot = os.path.join(path_wavs,
-                                        np.random.choice(os.listdir(path_wavs)))
-                logger.info(f"The file that will be plotted is {wav_to_plot}")
+        if self.augmentmel:
+            wavs_to_plot = [random.choice(files) for files in class_files.values()]
+            for wav_to_plot in wavs_to_plot:
+                logger.info("The file that will be plotted is %s", wav_to_plot)
 
-                y, _ = torchaudio.load(wav_to_plot)
-                melspec = self.mel(y)
-                logger.info(f"The shape of the melspec is {melspec.shape}")
+            if augment:
+                # The augmented mels are random, the example of every class is loaded first so they are computed in a single batch
+                melspecs = self._batch_mel([self._load_clip(wav_to_plot)[0][0] for wav_to_plot in wavs_to_plot]).cpu()
+            else:
+                melspecs = [self._mel_for(wav_to_plot, augment)[0][0] for wav_to_plot in wavs_to_plot]
+            for av_class, melspec in zip(class_files, melspecs):
+                logger.info("The shape of the melspec is %s", melspec.shape)
 
+                # Long mels are subsampled in time to about the number of pixels that can be displayed
+                stride = max(1, melspec.shape[-1] // 2000)
                 plt.figure()
-                plt.imshow(melspec[0], origin="lower")
+                plt.imshow(melspec[:, ::stride].numpy(), origin="lower", aspect="auto")
                 plt.title(av_class)
                 plt.show()
         
-        if not self.yaml["augmentmel"] and self.yaml["melspec"]:
-            for av_class in available_classes:
-                path_wavs = os.path.join(path_classes, av_class)
-                wav_to_plot = os.path.join(path_wavs,
-                                        np.random.choice(os.listdir(path_wavs)))
-                logger.info(f"The file that will be plotted is {wav_to_plot}")
+        if not self.augmentmel and self.yaml["melspec"]:
+            for av_class, files in class_files.items():
+                wav_to_plot = random.choice(files)
+                logger.info("The file that will be plotted is %s", wav_to_plot)
 
-                y, _ = torchaudio.load(wav_to_plot)
-                melspec = self.mel(y)
-                logger.info(f"The shape of the melspec is {melspec.shape}")
+                melspec, _ = self._mel_for(wav_to_plot, augment)
+                logger.info("The shape of the melspec is %s", melspec.shape)
 
                 plt.figure(figsize=(10, 4))
-                librosa.display.specshow(melspec.cpu().numpy()[0], x_axis='time', y_axis='mel', sr=self.yaml["sr"], cmap='Greys', hop_length=self.yaml["hopsize"])
+                librosa.display.specshow(melspec.numpy()[0], x_axis='time', y_axis='mel', sr=self.sr, cmap='Greys', hop_length=self.yaml["hopsize"])
                 plt.title(av_class)
                 plt.show()
                 
         
-        elif not self.yaml["augmentmel"] and not self.yaml["melspec"]:
-            for av_class in available_classes:
-                path_wavs = os.path.join(path_classes, av_class)
-                wav_to_plot = os.path.join(path_wavs,
-                                        np.random.choice(os.listdir(path_wavs)))
-                logger.info(f"The file that will be plotted is {wav_to_plot}")
-
-                y, sr = torchaudio.load(wav_to_plot)
-                melspec = self.mel(y)
-                logger.info(f"The shape of the melspec is {melspec.shape}")
-                logger.info(f"The sampling rate is {sr}")
-                logger.info(f"The sampling rate in yaml is {self.yaml['sr']}")
+        elif not self.augmentmel and not self.yaml["melspec"]:
+            for av_class, files in class_files.items():
+                wav_to_plot = random.choice(files)
+                logger.info("The file that will be plotted is %s", wav_to_plot)
+
+                melspec, sr = self._mel_for(wav_to_plot, augment)
+                logger.info("The shape of the melspec is %s", melspec.shape)
+                logger.info("The sampling rate is %s", sr)
+                logger.info("The sampling rate in yaml is %s", self.sr)
 
                 plt.figure(figsize=(10, 4))
 
-                librosa.display.specshow(melspec.cpu().numpy()[0], x_axis='time', y_axis='linear', sr=self.yaml["sr"], cmap='Greys', hop_length=self.yaml["hopsize"])
+                librosa.display.specshow(melspec.numpy()[0], x_axis='time', y_axis='linear', sr=self.sr, cmap='Greys', hop_length=self.yaml["hopsize"])
                 plt.title(av_class)
                 plt.show()
 
@@ -18,6 +18,11 @@ import json
 from argparse import Namespace
 import time
 import yaml
+try:
+    # libyaml emitter, much faster than the pure Python one
+    from yaml import CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeDumper
 
 import numpy as np
 import matplotlib.pyplot as plt
@@ -144,7 +149,7 @@ class PasstModel():
         output_config_path = results_folder / 'configuration.yaml'
         logging.info(f"Saving configuration in {output_config_path}")
         with open(str(output_config_path), 'w', encoding="utf-8") as outfile:
-            yaml.dump(self.yaml, outfile, default_flow_style=False)
+            yaml.dump(self.yaml, outfile, Dumper=SafeDumper, default_flow_style=False)
         logging.info(f"Config params:\n {self.yaml}")
 
         train_dataloader, test_dataloader = self.load_train_test_datasets()
@@ -73,19 +73,20 @@ def create_exp_dir(name: str, model: str, task: str) -> str:
     return str(exp_path)
 
 
-def process_audio_for_inference(path_audio: str, desired_sr: float, desired_duration: float) -> tuple[torch.Tensor, float, float]:
+def process_audio_for_inference(path_audio: str, desired_sr: float, desired_duration: float, mono: bool = False) -> tuple[torch.Tensor, float, float]:
     """Processes audios for inference purposes ensuring each segment is of desired duration.
 
     Args:
         path_audio (str): Path to the audio that needs to be processed
         desired_sr (float): The desired sampling rate
         desired_duration (float): The desired duration in seconds
+        mono (bool, optional): If True, the channels are averaged and the chunks are returned as a single (n_chunks, n_samples) batch. Defaults to False.
 
     Raises:
         ValueError: In case the sampling rate of a signal is lower than the desired one.
 
     Returns:
-        tuple: The processed signal tensor, updated sampling rate, and the original audio duration
+        tuple: The processed signal tensor, of shape (channels, n_chunks, n_samples) or (n_chunks, n_samples) if mono, and the updated sampling rate
     """
     y, sr = torchaudio.load(path_audio)
 
@@ -93,7 +94,7 @@ def process_audio_for_inference(path_audio: str, desired_sr: float, desired_dura
         raise ValueError(f"Sampling rate of {sr} Hz is lower than the desired sampling rate of {desired_sr} Hz.")
     
     if sr != desired_sr:
-        y = librosa.resample(y=y.detach().numpy(), orig_sr=sr, target_sr=32_000)
+        y = librosa.resample(y=y.detach().numpy(), orig_sr=sr, target_sr=desired_sr)
         y = torch.Tensor(y)
         sr = desired_sr 
 
@@ -108,6 +109,8 @@ def process_audio_for_inference(path_audio: str, desired_sr: float, desired_dura
         y = torch.nn.functional.pad(y, (0, padding_size))
 
     y = y.unfold(dimension=1, size=length, step=length)
+    if mono:
+        y = y.mean(dim=0)
 
     return y, sr
 
@@ -203,7 +206,7 @@ def process_data_for_inference(path_audio: str, desired_sr: float, desired_durat
     Returns:
     list: List of processed segments.
     """
-    signal, original_sr = sf.read(path_audio)
+    signal, original_sr = sf.read(path_audio, dtype='float32')
     # Resample the signal if the original sampling rate is different from the target
     if original_sr != desired_sr:
         signal = librosa.resample(y=signal, orig_sr=original_sr, target_sr=desired_sr)
@@ -280,32 +283,52 @@ class AugmentMelSTFT(nn.Module):
             self.timem = torchaudio.transforms.TimeMasking(timem, iid_masks=True)
 
 
+    def _mel_basis(self, fmin: float, fmax: float) -> torch.Tensor:
+        """Computes the mel filterbank between two frequencies.
+
+        Args:
+            fmin (float): The lowest frequency of the filterbank.
+            fmax (float): The highest frequency of the filterbank.
+
+        Returns:
+            torch.Tensor: The filterbank, of shape (n_mels, n_fft // 2 + 1).
+        """
+        mel_basis, _ = torchaudio.compliance.kaldi.get_mel_banks(self.n_mels,  self.n_fft, self.sr,
+                                        fmin, fmax, vtln_low=100.0, vtln_high=-500., vtln_warp_factor=1.0)
+        return torch.nn.functional.pad(mel_basis, (0, 1), mode='constant', value=0)
+
+
     def forward(self, x):
         # x = nn.functional.conv1d(x.unsqueeze(1), self.preemphasis_coefficient).squeeze(1)  # Makes the mels look bad
         x = torch.stft(x, self.n_fft, hop_length=self.hopsize, win_length=self.win_length,
                        center=True, normalized=False, window=self.window, return_complex=False)
         x = (x ** 2).sum(dim=-1)  # power mag
         # GOOD ONES
-        fmin = self.fmin + torch.randint(self.fmin_aug_range, (1,)).item()
-        fmax = self.fmax + self.fmax_aug_range // 2 - torch.randint(self.fmax_aug_range, (1,)).item()
+        # Each clip of a batch gets its own random band edges, as if the clips were processed one by one
+        n_clips = x.shape[0] if x.dim() == 3 else 1
+        fmins = (self.fmin + torch.randint(self.fmin_aug_range, (n_clips,))).tolist()
+        fmaxs = (self.fmax + self.fmax_aug_range // 2 - torch.randint(self.fmax_aug_range, (n_clips,))).tolist()
         
         # don't augment eval data
         if not self.training:
-            fmin = self.fmin
-            fmax = self.fmax
+            fmins = [self.fmin]
+            fmaxs = [self.fmax]
 
-        mel_basis, _ = torchaudio.compliance.kaldi.get_mel_banks(self.n_mels,  self.n_fft, self.sr,
-                                        fmin, fmax, vtln_low=100.0, vtln_high=-500., vtln_warp_factor=1.0)
-        mel_basis = torch.as_tensor(torch.nn.functional.pad(mel_basis, (0, 1), mode='constant', value=0),
-                                    device=x.device)
+        mel_basis = torch.stack([self._mel_basis(fmin, fmax) for fmin, fmax in zip(fmins, fmaxs)]).to(x.device)
+        if x.dim() == 2:
+            mel_basis = mel_basis[0]
         with torch.cuda.amp.autocast(enabled=False):
-            melspec = torch.matmul(mel_basis, x)
+            melspec = torch.matmul(mel_basis, x)  # A single filterbank is broadcast over the whole batch
 
         melspec = (melspec + 0.00001).log()
 
         if self.training:
-            melspec = self.freqm(melspec)
-            melspec = self.timem(melspec)
+            # The masks are only drawn independently for each clip on (batch, channel, freq, time) inputs
+            if melspec.dim() == 3:
+                melspec = self.timem(self.freqm(melspec.unsqueeze(1))).squeeze(1)
+            else:
+                melspec = self.freqm(melspec)
+                melspec = self.timem(melspec)
 
         melspec = (melspec + 4.5) / 5.  # fast normalization
 
@@ -249,7 +249,7 @@ class VggishModel():
             for label in unique_data_labels:
                 audio_files = os.listdir(os.path.join(data_path, split, label))
                 for audio in audio_files:
-                    signal, sr = sf.read(os.path.join(data_path, split, label,audio))
+                    signal, sr = sf.read(os.path.join(data_path, split, label,audio), dtype='float32')
                     x_data.append(signal)
                     y_data.append(label)
                     